@@ -0,0 +1,109 @@
+# benchmark of loose object writes at every zlib level: throughput against size on disk
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# import libwyag from the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import libwyag
+
+argparser = argparse.ArgumentParser(description="Benchmark loose object compression levels")
+
+argparser.add_argument("-n",
+                       dest="blobs",
+                       type=int,
+                       default=400,
+                       help="Number of blobs of each kind")
+
+argparser.add_argument("-r",
+                       dest="repeat",
+                       type=int,
+                       default=3,
+                       help="Number of runs, the best one is reported")
+
+argparser.add_argument("-l",
+                       dest="levels",
+                       default="-1,0,1,3,6,9",
+                       help="Comma separated zlib levels to measure, -1 is the zlib default")
+
+# words source code and prose are made of
+WORDS = [ "def", "return", "self", "if", "else", "for", "in", "import", "class", "None", "True",
+          "repo", "object", "path", "data", "sha", "index", "tree", "commit", "the", "of", "a" ]
+
+# source like text: short lines of common words with some indentation
+def blob_text(rng, size):
+  lines = list()
+  total = 0
+  while total < size:
+    line = "  " * rng.randrange(4) + " ".join(rng.choice(WORDS) for _ in range(rng.randrange(2, 10)))
+    lines.append(line)
+    total += len(line) + 1
+  return "\n".join(lines).encode("utf8")[:size]
+
+# log like text: the same lines with a changing counter, compresses very well
+def blob_log(rng, size):
+  ret = bytearray()
+  i = rng.randrange(1000000)
+  while len(ret) < size:
+    ret += "2024-01-01 12:00:{0:02d} INFO request {1} handled in {2} ms\n".format(i % 60, i, i % 97).encode("ascii")
+    i += 1
+  return bytes(ret[:size])
+
+# binary data that does not compress, like images or archives
+def blob_binary(rng, size):
+  return rng.randbytes(size)
+
+# the kinds of blobs and their sizes
+MIXES = [
+  ("text", blob_text, 8 * 1024),
+  ("log", blob_log, 64 * 1024),
+  ("binary", blob_binary, 32 * 1024),
+  ("small", blob_text, 256),
+]
+
+# make the blobs of every kind, the same ones for every level
+def blobs_make(count):
+  rng = random.Random(42)
+  return [ (name, [ libwyag.GitBlob(make(rng, size)) for _ in range(count) ]) for name, make, size in MIXES ]
+
+# write the blobs into a fresh repo at the given level, returns the seconds taken and the bytes on disk
+def write(blobs, level):
+  path = tempfile.mkdtemp(prefix="wyag_bench_")
+  try:
+    libwyag.repo_create(path)
+    repo = libwyag.GitRepository(path)
+    repo.conf.set("core", "looseCompression", str(level))
+
+    start = time.perf_counter()
+    for blob in blobs:
+      libwyag.object_write(blob, repo)
+    elapsed = time.perf_counter() - start
+
+    size = 0
+    for root, _, names in os.walk(libwyag.repo_path(repo, "objects")):
+      size += sum(os.path.getsize(os.path.join(root, n)) for n in names)
+    return elapsed, size
+  finally:
+    shutil.rmtree(path)
+
+def main(argv=sys.argv[1:]):
+  args = argparser.parse_args(argv)
+  levels = [ int(l) for l in args.levels.split(",") ]
+  mixes = blobs_make(args.blobs)
+
+  print("{0} blobs of each kind, best of {1}".format(args.blobs, args.repeat))
+  print("{0:<8} {1:>5} {2:>10} {3:>12} {4:>8}".format("kind", "level", "MB/s", "disk bytes", "ratio"))
+  for name, blobs in mixes:
+    raw = sum(len(b.blobdata) for b in blobs)
+    for level in levels:
+      runs = [ write(blobs, level) for _ in range(args.repeat) ]
+      elapsed = min(r[0] for r in runs)
+      size = runs[0][1]
+      print("{0:<8} {1:>5} {2:>10.1f} {3:>12} {4:>8.3f}".format(name, level, raw / elapsed / 1e6, size, size / raw))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,110 @@
+# benchmark of the startup of wyag: import time of libwyag and wall time of a trivial command
+# exits with status 1 when a budget is exceeded or when a module meant to be imported lazily is imported up front
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+argparser = argparse.ArgumentParser(description="Benchmark wyag startup")
+
+argparser.add_argument("-r",
+                       dest="repeat",
+                       type=int,
+                       default=20,
+                       help="Number of runs, the median is compared to the budget")
+
+argparser.add_argument("--import-budget",
+                       dest="import_budget",
+                       type=float,
+                       default=30.0,
+                       help="Budget for importing libwyag, in milliseconds")
+
+argparser.add_argument("--command-budget",
+                       dest="command_budget",
+                       type=float,
+                       default=80.0,
+                       help="Budget for running wyag rev-parse HEAD, in milliseconds")
+
+argparser.add_argument("--top",
+                       type=int,
+                       default=10,
+                       help="Number of slowest imports to list")
+
+# modules only some commands need, importing libwyag must not import them
+LAZY_MODULES = [ "concurrent.futures", "ctypes", "datetime", "fnmatch", "hashlib", "json",
+                 "select", "socket", "tempfile", "threading" ]
+
+# run python -X importtime importing libwyag, returns { module: (self us, cumulative us) }
+def importtime():
+  out = subprocess.run([ sys.executable, "-X", "importtime", "-c", "import libwyag" ],
+                       cwd=ROOT, capture_output=True, check=True)
+  ret = dict()
+  for line in out.stderr.decode("utf8").splitlines():
+    if not line.startswith("import time:") or "|" not in line:
+      continue
+    fields = line[len("import time:"):].split("|")
+    try:
+      ret[fields[2].strip()] = (int(fields[0]), int(fields[1]))
+    except ValueError:
+      pass # the header line
+  return ret
+
+# wall time of running a command through the wyag script, in milliseconds
+def command_time(cwd, *args):
+  start = time.perf_counter()
+  subprocess.run([ sys.executable, os.path.join(ROOT, "wyag") ] + list(args), cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+  return (time.perf_counter() - start) * 1000
+
+def main(argv=sys.argv[1:]):
+  args = argparser.parse_args(argv)
+  failed = False
+
+  runs = [ importtime() for _ in range(args.repeat) ]
+  total = statistics.median(r["libwyag"][1] for r in runs) / 1000
+  print("import libwyag: {0:.2f} ms median of {1}, budget {2:.2f} ms".format(total, args.repeat, args.import_budget))
+  if total > args.import_budget:
+    failed = True
+
+  print("slowest imports, cumulative:")
+  last = runs[-1]
+  for name, (_, cumulative) in sorted(last.items(), key=lambda m: -m[1][1])[:args.top]:
+    print("  {0:<30} {1:8.2f} ms".format(name, cumulative / 1000))
+
+  eager = [ m for m in LAZY_MODULES if m in last ]
+  if eager:
+    print("imported up front, should be lazy: {0}".format(", ".join(eager)))
+    failed = True
+
+  # a trivial command in a fresh repository, startup dominates it
+  tmp = tempfile.mkdtemp(prefix="wyag_bench_")
+  try:
+    subprocess.run([ sys.executable, os.path.join(ROOT, "wyag"), "init", tmp ], check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(tmp, ".git", "refs", "heads", "master"), "w") as f:
+      f.write("0" * 40 + "\n")
+    times = [ command_time(tmp, "rev-parse", "HEAD") for _ in range(args.repeat) ]
+  finally:
+    shutil.rmtree(tmp)
+
+  median = statistics.median(times)
+  python = statistics.median(command_time_python() for _ in range(args.repeat))
+  print("wyag rev-parse HEAD: {0:.2f} ms median, {1:.2f} ms of it python itself, budget {2:.2f} ms".format(median, python, args.command_budget))
+  if median > args.command_budget:
+    failed = True
+
+  print("FAILED" if failed else "OK")
+  sys.exit(1 if failed else 0)
+
+# wall time of starting python doing nothing, the floor of any command
+def command_time_python():
+  start = time.perf_counter()
+  subprocess.run([ sys.executable, "-c", "pass" ], check=True)
+  return (time.perf_counter() - start) * 1000
+
+if __name__ == "__main__":
+  main()
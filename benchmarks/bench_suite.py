@@ -0,0 +1,233 @@
+# benchmark suite: hot functions in process and commands end to end, on a synthetic repository
+# results are written as json, two result files can be compared with --compare
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# import libwyag from the directory above
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import libwyag
+import synthetic_repo
+
+argparser = argparse.ArgumentParser(description="Run the benchmark suite")
+
+synthetic_repo.shape_arguments(argparser)
+
+argparser.add_argument("-r",
+                       dest="repeat",
+                       type=int,
+                       default=5,
+                       help="Number of runs of every benchmark")
+
+argparser.add_argument("-o",
+                       dest="output",
+                       default=None,
+                       help="Write the results to this file instead of stdout")
+
+argparser.add_argument("--repo",
+                       default=None,
+                       help="Benchmark this repository instead of generating one")
+
+argparser.add_argument("--only",
+                       default=None,
+                       help="Comma separated names of the benchmarks to run")
+
+argparser.add_argument("--compare",
+                       nargs=2,
+                       metavar=("BASE", "NEW"),
+                       default=None,
+                       help="Compare two result files instead of running anything")
+
+# run fn repeat times, returns the seconds of every run
+def measure(fn, repeat):
+  ret = list()
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    ret.append(time.perf_counter() - start)
+  return ret
+
+# the shas of every object reachable from HEAD, by type
+def repo_objects(repo):
+  head = libwyag.ref_resolve(repo, "HEAD")
+  ret = { b'commit': [], b'tree': [], b'blob': [] }
+  for sha, fmt, _, _ in libwyag.object_walk(repo, [ head ]):
+    ret.setdefault(fmt, []).append(sha)
+  return ret
+
+# benchmarks of single functions, each returns (name, number of operations, function to time)
+def function_benchmarks(path, objects):
+  rng = random.Random(1)
+  sample = rng.sample(objects[b'blob'], min(500, len(objects[b'blob']))) \
+         + rng.sample(objects[b'tree'], min(500, len(objects[b'tree']))) \
+         + rng.sample(objects[b'commit'], min(500, len(objects[b'commit'])))
+
+  # the raw data of commits and trees, for the parsers alone
+  repo = libwyag.GitRepository(path)
+  commits = [ libwyag.object_read_raw(repo, sha)[1] for sha in objects[b'commit'] ]
+  trees = [ libwyag.object_read_raw(repo, sha)[1] for sha in objects[b'tree'] ]
+
+  # a fresh repository object every run so the object cache starts cold
+  def read():
+    repo = libwyag.GitRepository(path)
+    for sha in sample:
+      libwyag.object_read(repo, sha)
+
+  blobs = [ libwyag.GitBlob(os.urandom(16).hex().encode("ascii") * 64) for _ in range(500) ]
+  def write():
+    scratch = tempfile.mkdtemp(prefix="wyag_bench_")
+    try:
+      libwyag.repo_create(scratch)
+      repo = libwyag.GitRepository(scratch)
+      for blob in blobs:
+        libwyag.object_write(blob, repo)
+    finally:
+      shutil.rmtree(scratch)
+
+  # the trees of commits with one parent and of their parent, diffed with a fresh repository so the trees are read
+  def commit_tree(sha):
+    return libwyag.object_read(repo, sha).kvlm[b'tree'].decode("ascii")
+  pairs = list()
+  for sha in objects[b'commit'][:200]:
+    parents = libwyag.commit_parents(repo, sha)
+    if len(parents) == 1:
+      pairs.append((commit_tree(parents[0]), commit_tree(sha)))
+
+  def diff():
+    repo = libwyag.GitRepository(path)
+    for old, new in pairs:
+      for _ in libwyag.diff_tree(repo, old, new):
+        pass
+
+  def kvlm():
+    for raw in commits:
+      libwyag.kvlm_parse(raw)
+
+  def tree():
+    for raw in trees:
+      libwyag.tree_parse(raw)
+
+  return [
+    ("object_read", len(sample), read),
+    ("object_write", len(blobs), write),
+    ("kvlm_parse", len(commits), kvlm),
+    ("tree_parse", len(trees), tree),
+    ("diff_tree", len(pairs), diff),
+  ]
+
+# benchmarks of whole commands, run through the wyag script like a user would
+def command_benchmarks(path, objects):
+  wyag = [ sys.executable, os.path.join(ROOT, "wyag") ]
+
+  def run(*args):
+    subprocess.run(wyag + list(args), cwd=path, check=True, stdout=subprocess.DEVNULL)
+
+  def checkout():
+    dest = tempfile.mkdtemp(prefix="wyag_bench_")
+    try:
+      run("checkout", "HEAD", os.path.join(dest, "out"))
+    finally:
+      shutil.rmtree(dest)
+
+  # abbreviated shas of commits, resolved in one process
+  names = [ sha[:10] for sha in random.Random(2).sample(objects[b'commit'], min(200, len(objects[b'commit']))) ]
+
+  return [
+    ("log", 1, lambda: run("log", "--oneline")),
+    ("ls-tree -r", 1, lambda: run("ls-tree", "-r", "HEAD")),
+    ("checkout", 1, checkout),
+    ("rev-parse", len(names), lambda: run("rev-parse", *names)),
+  ]
+
+# version of the code being measured, so result files say what they measured
+def code_version():
+  try:
+    out = subprocess.run([ "git", "rev-parse", "HEAD" ], cwd=ROOT, capture_output=True, check=True)
+    return out.stdout.decode("ascii").strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run(args):
+  results = list()
+  only = set(args.only.split(",")) if args.only else None
+
+  tmp = None
+  path = args.repo
+  if not path:
+    tmp = tempfile.mkdtemp(prefix="wyag_bench_")
+    path = os.path.join(tmp, "repo")
+    start = time.perf_counter()
+    synthetic_repo.generate(path, args)
+    print("Generated the repository in {0:.2f} s".format(time.perf_counter() - start), file=sys.stderr)
+
+  try:
+    objects = repo_objects(libwyag.GitRepository(path))
+
+    for kind, benchmarks in (("function", function_benchmarks), ("command", command_benchmarks)):
+      for name, ops, fn in benchmarks(path, objects):
+        if only and name not in only:
+          continue
+        runs = measure(fn, args.repeat)
+        results.append({
+          "name": name,
+          "kind": kind,
+          "ops": ops,
+          "runs": runs,
+          "best": min(runs),
+          "mean": sum(runs) / len(runs),
+          "per_op": min(runs) / ops,
+        })
+        print("{0:<14} {1:>10.2f} ms".format(name, min(runs) * 1000), file=sys.stderr)
+  finally:
+    if tmp:
+      shutil.rmtree(tmp)
+
+  shape = { k: getattr(args, k) for k in ("commits", "merge_rate", "width", "fanout", "depth", "blob_size", "blob_sigma", "changes", "seed") }
+  return {
+    "version": code_version(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "machine": platform.machine(),
+    "repo": args.repo,
+    "shape": None if args.repo else shape,
+    "counts": { fmt.decode("ascii"): len(shas) for fmt, shas in objects.items() },
+    "repeat": args.repeat,
+    "results": results,
+  }
+
+# print the ratio of the best times of two result files, above 1 is slower
+def compare(base, new):
+  with open(base) as f:
+    base = { r["name"]: r for r in json.load(f)["results"] }
+  with open(new) as f:
+    new = { r["name"]: r for r in json.load(f)["results"] }
+
+  print("{0:<14} {1:>10} {2:>10} {3:>8}".format("benchmark", "base ms", "new ms", "ratio"))
+  for name, r in new.items():
+    if name in base:
+      print("{0:<14} {1:>10.2f} {2:>10.2f} {3:>8.2f}".format(name, base[name]["best"] * 1000, r["best"] * 1000, r["best"] / base[name]["best"]))
+
+def main(argv=sys.argv[1:]):
+  args = argparser.parse_args(argv)
+  if args.compare:
+    compare(*args.compare)
+    return
+
+  report = run(args)
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,89 @@
+# benchmark of the tree parser against the one that decoded every entry up front
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+# import libwyag from the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import libwyag
+
+argparser = argparse.ArgumentParser(description="Benchmark tree parsing")
+
+argparser.add_argument("-n",
+                       dest="entries",
+                       type=int,
+                       default=100000,
+                       help="Number of entries in the tree")
+
+argparser.add_argument("-r",
+                       dest="repeat",
+                       type=int,
+                       default=5,
+                       help="Number of runs, the best one is reported")
+
+# the previous leaf: a plain object holding a decoded path and a hex sha
+class OldTreeLeaf(object):
+  def __init__(self, mode, path, sha):
+    self.mode = mode
+    self.path = path
+    self.sha = sha
+
+# the previous parser, one entry at a time with the sha round tripped through an int
+def old_tree_parse_one(raw, start=0):
+  x = raw.find(b' ', start)
+  mode = raw[start:x]
+  y = raw.find(b'\x00', x)
+  path = raw[x+1:y]
+  sha = format(int.from_bytes(raw[y+1:y+21], "big"), "040x")
+  return y+21, OldTreeLeaf(mode, path.decode("utf8"), sha)
+
+def old_tree_parse(raw):
+  pos = 0
+  max = len(raw)
+  ret = list()
+
+  while pos < max:
+    pos, data = old_tree_parse_one(raw, pos)
+    ret.append(data)
+
+  return ret
+
+# build the raw data of a tree with the given number of entries
+def tree_make(entries):
+  ret = list()
+  for i in range(entries):
+    mode = b"40000" if i % 10 == 0 else b"100644"
+    path = "file_{0:08d}.txt".format(i).encode("utf8")
+    ret.append(mode + b' ' + path + b'\x00' + hashlib.sha1(path).digest())
+  return b''.join(ret)
+
+# best time of running fn repeat times
+def best(fn, repeat):
+  ret = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    ret = elapsed if ret is None else min(ret, elapsed)
+  return ret
+
+def main(argv=sys.argv[1:]):
+  args = argparser.parse_args(argv)
+  raw = tree_make(args.entries)
+
+  # parsing alone, then parsing plus reading every mode, sha and path like ls-tree does
+  cases = [
+    ("parse", lambda parse: parse(raw)),
+    ("parse+decode", lambda parse: [ (l.mode, l.sha, l.path) for l in parse(raw) ]),
+  ]
+
+  print("{0} entries, {1} bytes, best of {2}".format(args.entries, len(raw), args.repeat))
+  for name, case in cases:
+    old = best(lambda: case(old_tree_parse), args.repeat)
+    new = best(lambda: case(libwyag.tree_parse), args.repeat)
+    print("{0:<14} old {1:8.2f} ms  new {2:8.2f} ms  speedup {3:.2f}x".format(name, old * 1000, new * 1000, old / new))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,197 @@
+# generator of synthetic repositories of a given shape, the same seed always gives the same repository
+import argparse
+import collections
+import math
+import os
+import random
+import sys
+
+# import libwyag from the directory above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import libwyag
+
+argparser = argparse.ArgumentParser(description="Generate a synthetic repository")
+
+argparser.add_argument("path",
+                       help="Where to create the repository, must not exist or be empty")
+
+# the shape of a repository, shared with the benchmark suite
+def shape_arguments(parser):
+  parser.add_argument("--commits",
+                      type=int,
+                      default=500,
+                      help="Number of commits, merges included")
+
+  parser.add_argument("--merge-rate",
+                      dest="merge_rate",
+                      type=float,
+                      default=0.1,
+                      help="Probability that a commit starts a side branch merged back later")
+
+  parser.add_argument("--width",
+                      type=int,
+                      default=20,
+                      help="Number of files in every directory")
+
+  parser.add_argument("--fanout",
+                      type=int,
+                      default=3,
+                      help="Number of subdirectories in every directory above the deepest level")
+
+  parser.add_argument("--depth",
+                      type=int,
+                      default=3,
+                      help="Number of directory levels below the root")
+
+  parser.add_argument("--blob-size",
+                      dest="blob_size",
+                      type=int,
+                      default=4096,
+                      help="Median blob size in bytes, sizes follow a log-normal distribution")
+
+  parser.add_argument("--blob-sigma",
+                      dest="blob_sigma",
+                      type=float,
+                      default=1.0,
+                      help="Spread of the log-normal blob size distribution")
+
+  parser.add_argument("--changes",
+                      type=int,
+                      default=3,
+                      help="Number of files changed by every commit")
+
+  parser.add_argument("--seed",
+                      type=int,
+                      default=1,
+                      help="Seed of the generator")
+
+shape_arguments(argparser)
+
+# words the blob contents are made of, so they compress like source code
+WORDS = [ "def", "return", "self", "if", "else", "for", "in", "import", "class", "None", "True",
+          "repo", "object", "path", "data", "sha", "index", "tree", "commit", "the", "of", "a" ]
+
+# directory of the model worktree, its tree sha is kept until something below it changes
+class Dir(object):
+  def __init__(self):
+    self.files = dict() # name -> blob sha
+    self.dirs = dict()  # name -> Dir
+    self.sha = None     # sha of the tree, None when it has to be written again
+
+# generates the objects of a synthetic repository
+class Generator(object):
+  def __init__(self, repo, args):
+    self.repo = repo
+    self.args = args
+    self.rng = random.Random(args.seed)
+    self.time = 1500000000
+    self.blobs = 0
+
+    # the contents are slices of one block of text, made unique by a header line
+    self.text = self.text_make(max(args.blob_size * 16, 1 << 20))
+
+    self.root = Dir()
+    self.paths = list() # (dirs leading to the file, name) of every file
+    self.populate(self.root, [], args.depth)
+
+  def text_make(self, size):
+    lines = list()
+    total = 0
+    while total < size:
+      line = "  " * self.rng.randrange(4) + " ".join(self.rng.choice(WORDS) for _ in range(self.rng.randrange(2, 10)))
+      lines.append(line)
+      total += len(line) + 1
+    return "\n".join(lines).encode("ascii")
+
+  # a new blob of a size drawn from the distribution
+  def blob(self):
+    size = min(int(self.rng.lognormvariate(math.log(self.args.blob_size), self.args.blob_sigma)), len(self.text))
+    start = self.rng.randrange(len(self.text) - size + 1)
+    self.blobs += 1
+    data = "blob {0}\n".format(self.blobs).encode("ascii") + self.text[start:start + size]
+    return libwyag.object_write(libwyag.GitBlob(data), self.repo)
+
+  # fill a directory with files and subdirectories
+  def populate(self, node, dirs, depth):
+    for i in range(self.args.width):
+      name = "file{0}.txt".format(i)
+      node.files[name] = self.blob()
+      self.paths.append((dirs + [ node ], name))
+
+    if depth > 0:
+      for i in range(self.args.fanout):
+        child = node.dirs["dir{0}".format(i)] = Dir()
+        self.populate(child, dirs + [ node ], depth - 1)
+
+  # change some files, the trees above them have to be written again
+  def change(self):
+    for _ in range(self.args.changes):
+      dirs, name = self.rng.choice(self.paths)
+      dirs[-1].files[name] = self.blob()
+      for node in dirs:
+        node.sha = None
+
+  # write the trees that changed, returns the sha of the root
+  def tree(self, node):
+    if node.sha is None:
+      tree = libwyag.GitTree()
+      for name, sha in node.files.items():
+        tree.items.append(libwyag.GitTreeLeaf(b'100644', name.encode("utf8"), bytes.fromhex(sha)))
+      for name, child in node.dirs.items():
+        tree.items.append(libwyag.GitTreeLeaf(b'40000', name.encode("utf8"), bytes.fromhex(self.tree(child))))
+      node.sha = libwyag.object_write(tree, self.repo)
+    return node.sha
+
+  def commit(self, parents, message):
+    self.time += self.rng.randrange(60, 3600)
+    who = "Bench <bench@example.com> {0} +0000".format(self.time).encode("ascii")
+
+    commit = libwyag.GitCommit()
+    commit.kvlm = collections.OrderedDict()
+    commit.kvlm[b'tree'] = self.tree(self.root).encode("ascii")
+    if parents:
+      commit.kvlm[b'parent'] = [ p.encode("ascii") for p in parents ] if len(parents) > 1 else parents[0].encode("ascii")
+    commit.kvlm[b'author'] = who
+    commit.kvlm[b'committer'] = who
+    commit.kvlm[None] = message.encode("utf8") + b'\n'
+    return libwyag.object_write(commit, self.repo)
+
+  # the history: mostly linear, with side branches of one to three commits merged back
+  def run(self):
+    head = None
+    count = 0
+
+    while count < self.args.commits:
+      if head and self.rng.random() < self.args.merge_rate and count + 2 < self.args.commits:
+        side = head
+        for _ in range(min(self.rng.randint(1, 3), self.args.commits - count - 1)):
+          self.change()
+          side = self.commit([ side ], "Side commit {0}".format(count))
+          count += 1
+        head = self.commit([ head, side ], "Merge side branch at {0}".format(count))
+      else:
+        self.change()
+        head = self.commit([ head ] if head else [], "Commit {0}".format(count))
+      count += 1
+
+      # a tag every hundred commits, for the ref lookups
+      if count % 100 == 0:
+        libwyag.ref_create(self.repo, "tags/v{0}".format(count // 100), head)
+
+    libwyag.ref_create(self.repo, "heads/master", head)
+    return head
+
+# create a repository of the given shape at path, returns it
+def generate(path, args):
+  libwyag.repo_create(path)
+  repo = libwyag.GitRepository(path)
+  Generator(repo, args).run()
+  return repo
+
+def main(argv=sys.argv[1:]):
+  args = argparser.parse_args(argv)
+  repo = generate(args.path, args)
+  print("Generated {0} commits in {1}".format(args.commits, repo.worktree))
+
+if __name__ == "__main__":
+  main()
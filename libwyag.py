@@ -1,44 +1,252 @@
 # import all necessary libraries
+# only what most commands need is imported here, the rest is imported by the functions using it
+# so a command like rev-parse does not pay for thread pools, sockets or ctypes at startup
 import argparse
+import array
+import bisect
 import collections
 import configparser
-from datetime import datetime
-import pwd, grp  
-from fnmatch import fnmatch
-import hashlib
-from math import ceil
+import heapq
+import io
+import itertools
+import mmap
 import os
 import re
+import stat
+import struct
 import sys
+import time
 import zlib
 
-# define a parser to get the argument from command line
-argparser = argparse.ArgumentParser(description="Stupid content tracker")
-
-#set subparsers for the commands 
-argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
-argsubparsers.required = True
+# the commands, name -> (help, function adding its arguments to its parser)
+# the parsers are only built for the command being run
+commands = dict()
+
+# register the arguments of a command
+def command(name, help):
+  def register(fn):
+    commands[name] = (help, fn)
+    return fn
+  return register
+
+# options valid before any command, with whether they take a value
+ARGPARSER_GLOBAL_OPTIONS = { "--trace": False, "--trace-file": True }
+
+# build the argument parser with the subparser of one command, or of all of them
+def argparser_build(name=None):
+  # define a parser to get the argument from command line
+  argparser = argparse.ArgumentParser(description="Stupid content tracker")
+
+  # tracing for every command, WYAG_TRACE=1 or WYAG_TRACE=<file> does the same from the environment
+  argparser.add_argument("--trace",
+                         action="store_const",
+                         const="1",
+                         default=None,
+                         help="Print where the time went on stderr")
+
+  argparser.add_argument("--trace-file",
+                         metavar="file",
+                         dest="trace",
+                         default=None,
+                         help="Write a Chrome trace of the command to file")
+
+  #set subparsers for the commands 
+  argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+  argsubparsers.required = True
+
+  for n, (help, arguments) in commands.items():
+    if name is None or n == name:
+      arguments(argsubparsers.add_parser(n, help=help))
+
+  return argparser
+
+# the command named on the command line, None for help or anything unexpected
+def argv_command(argv):
+  i = 0
+  while i < len(argv):
+    arg = argv[i]
+    if not arg.startswith("-"):
+      return arg if arg in commands else None
+    name = arg.split("=", 1)[0]
+    if name not in ARGPARSER_GLOBAL_OPTIONS:
+      return None
+    i += 2 if ARGPARSER_GLOBAL_OPTIONS[name] and "=" not in arg else 1
+  return None
 
 # add the command line commands for the git tracker
 def main(argv = sys.argv[1:]):
-  args = argparser.parse_args(argv)
+  # help and errors need every command, a known command only its own parser
+  args = argparser_build(argv_command(argv)).parse_args(argv)
+
+  # like GIT_TRACE a boolean turns the summary on or off, anything else is the file of a Chrome trace
+  target = args.trace or os.environ.get("WYAG_TRACE")
+  if target and target.lower() in ("1", "true", "yes", "on"):
+    target = "1"
+  if target and target.lower() not in ("0", "false", "no", "off"):
+    trace_start(target)
+
+  try:
+    with trace_span(args.command):
+      main_command(args)
+  finally:
+    trace_finish()
+
+def main_command(args):
   match args.command:
     case "add"                 :cmd_add(args)
-    case "cat-file"            :cmd_cat_files(args)
+    case "cat-file"            :cmd_cat_file(args)
     case "check-ignore"        :cmd_check_ignore(args)
     case "checkout"            :cmd_checkout(args)
+    case "commit-graph"        :cmd_commit_graph(args)
+    case "diff-tree"           :cmd_diff_tree(args)
+    case "fsmonitor"           :cmd_fsmonitor(args)
+    case "gc"                  :cmd_gc(args)
     case "hash-object"         :cmd_hash_object(args)
     case "init"                :cmd_init(args)
     case "log"                 :cmd_log(args)
     case "ls-files"            :cmd_ls_files(args)
     case "ls-tree"             :cmd_ls_tree(args)
+    case "pack-refs"           :cmd_pack_refs(args)
+    case "repack"              :cmd_repack(args)
     case "rev-parse"           :cmd_rev_parse(args)
     case "rm"                  :cmd_rm(args)
+    case "serve"               :cmd_serve(args)
     case "show-ref"            :cmd_show_ref(args)
     case "status"              :cmd_status(args)
     case "tag"                 :cmd_tag(args)
     case _                     :print("Bad command.")
 
+# the trace of the running command, None unless tracing was asked for
+# hot paths only test it before counting, so tracing costs nothing when it is off
+trace = None
+
+# counters and timed spans of a command, shown as a summary or written as a Chrome trace
+class GitTrace(object):
+  """Instrumentation of one command"""
+
+  def __init__(self, target):
+    import threading
+    self.target = target # "1" for a summary on stderr, else the file of the Chrome trace
+    self.start = time.perf_counter()
+    self.counters = collections.Counter()
+    self.spans = list()  # (name, start, duration, thread)
+    self.lock = threading.Lock() # counters are bumped from the worker threads too
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] += n
+
+  def span(self, name):
+    return GitTraceSpan(self, name)
+
+# a timed phase of the command
+class GitTraceSpan(object):
+  """Timed span of a trace"""
+
+  def __init__(self, trace, name):
+    self.trace = trace
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, type, value, tb):
+    import threading
+    end = time.perf_counter()
+    with self.trace.lock:
+      self.trace.spans.append((self.name, self.start, end - self.start, threading.get_ident()))
+    return False
+
+# what trace_span returns when tracing is off
+class GitTraceNull(object):
+  """Span doing nothing"""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, tb):
+    return False
+
+TRACE_NULL = GitTraceNull()
+
+# time a phase: with trace_span("index_read"): ...
+def trace_span(name):
+  return trace.span(name) if trace else TRACE_NULL
+
+# time every call of a function, only for coarse ones: the wrapper costs a call even when tracing is off
+def traced(fn):
+  def call(*args, **kwargs):
+    if not trace:
+      return fn(*args, **kwargs)
+    with trace.span(fn.__name__):
+      return fn(*args, **kwargs)
+  call.__name__ = fn.__name__
+  call.__doc__ = fn.__doc__
+  return call
+
+# the filesystem calls counted while tracing, every os.path helper goes through them
+TRACE_OS_CALLS = [ "stat", "lstat", "listdir", "scandir" ]
+
+# start tracing, the filesystem calls are wrapped to count them
+def trace_start(target):
+  global trace
+  trace = GitTrace(target)
+
+  for name in TRACE_OS_CALLS:
+    setattr(os, name, trace_os_call(name, getattr(os, name)))
+
+def trace_os_call(name, fn):
+  def call(*args, **kwargs):
+    if trace:
+      trace.count(name)
+    return fn(*args, **kwargs)
+  call.wrapped = fn
+  return call
+
+# stop tracing, then print the summary or write the Chrome trace
+def trace_finish():
+  global trace
+  if not trace:
+    return
+
+  done, trace = trace, None
+  for name in TRACE_OS_CALLS:
+    setattr(os, name, getattr(os, name).wrapped)
+
+  if done.target == "1":
+    trace_summary(done)
+  else:
+    trace_chrome(done)
+
+# time and calls of every span name, then the counters, on stderr
+def trace_summary(done):
+  spans = collections.OrderedDict()
+  for name, _, duration, _ in done.spans:
+    calls, total = spans.get(name, (0, 0))
+    spans[name] = (calls + 1, total + duration)
+
+  out = sys.stderr
+  print("trace: {0:.3f} s".format(time.perf_counter() - done.start), file=out)
+  for name, (calls, total) in sorted(spans.items(), key=lambda s: -s[1][1]):
+    print("  {0:<28} {1:>8} calls {2:>10.2f} ms".format(name, calls, total * 1000), file=out)
+  for name, value in sorted(done.counters.items()):
+    print("  {0:<28} {1:>8}".format(name, value), file=out)
+
+# write the spans as complete events and the counters as a counter event, in the trace event format
+def trace_chrome(done):
+  import json
+  pid = os.getpid()
+  events = list()
+  for name, start, duration, tid in done.spans:
+    events.append({ "name": name, "cat": "wyag", "ph": "X", "pid": pid, "tid": tid,
+                    "ts": (start - done.start) * 1e6, "dur": duration * 1e6 })
+  events.append({ "name": "counters", "ph": "C", "pid": pid, "tid": 0,
+                  "ts": (time.perf_counter() - done.start) * 1e6, "args": dict(done.counters) })
+
+  with open(done.target, "w") as f:
+    json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, f)
+
 # making the repo object
 class GitRepository(object):
   """A Git Repository"""
@@ -46,6 +254,18 @@ class GitRepository(object):
   worktree = None # path to the repo
   gitdir = None   # path to the .git directory
   conf = None     # config file
+  packs = None    # mapped packfiles, loaded on first object lookup
+  packs_mtime = None # mtime of objects/pack when the packs were loaded
+  object_cache = None # lru of parsed objects
+  graph = None    # mapped commit-graph
+  graph_mtime = None # mtime of the commit-graph when it was mapped
+  refs = None     # table of refs, loaded on first lookup
+  oids = None     # sorted object ids for abbreviated shas
+  objects = None  # objects known to exist, to skip probing before writes
+  fsync = None    # components whose writes are made durable, from core.fsync
+  batch = None    # write batch in progress, its objects are synced together
+  compression = None # zlib levels of loose objects and packs, from the config
+  index = None    # (stat of the index file, parsed index) of the last read
 
   # constructor for this class
   def __init__(self, path, force=False):
@@ -70,7 +290,96 @@ class GitRepository(object):
       vers = int(self.conf.get("core", "repositoryformatversion")) # gets the version fo the repo from the core part of the config
       if vers != 0:
         raise Exception("Unsupported repository version %s" %vers)
-      
+
+    # cache of parsed objects, bounded by core.objectCacheLimit bytes
+    limit = config_size(self.conf.get("core", "objectcachelimit", fallback=None), OBJECT_CACHE_LIMIT)
+    self.object_cache = GitObjectCache(limit)
+
+  # group object writes so they are made durable together, with core.fsyncMethod=batch
+  def write_batch(self):
+    return GitWriteBatch(self)
+
+# zlib level of loose objects or packs
+# core.looseCompression and pack.compression fall back to core.compression,
+# then to 1 for loose objects, which favours write speed, and to the zlib default for packs
+def repo_compression(repo, kind):
+  if repo.compression is None:
+    conf = repo.conf
+    core = conf.getint("core", "compression", fallback=None)
+    loose = conf.getint("core", "loosecompression", fallback=None)
+    pack = conf.getint("pack", "compression", fallback=None)
+
+    repo.compression = {
+      "loose": loose if loose is not None else core if core is not None else 1,
+      "pack": pack if pack is not None else core if core is not None else -1,
+    }
+    for level in repo.compression.values():
+      if not -1 <= level <= 9:
+        raise Exception("Bad zlib compression level {0}".format(level))
+
+  return repo.compression[kind]
+
+# parse a size from the config, git allows a k, m or g suffix
+def config_size(value, default):
+  if value is None:
+    return default
+
+  value = value.strip().lower()
+  units = { "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3 }
+  if value and value[-1] in units:
+    return int(value[:-1]) * units[value[-1]]
+  return int(value)
+
+# default capacity of the object cache in bytes
+OBJECT_CACHE_LIMIT = 64 * 1024 * 1024
+
+# least recently used cache of parsed objects, bounded by the size of their data
+# hits, misses and evictions are trace counters, so a long lived repository reports them per command
+class GitObjectCache(object):
+  """LRU of parsed GitObjects keyed by sha"""
+
+  def __init__(self, limit):
+    self.limit = limit  # capacity in bytes
+    self.size = 0       # bytes currently held
+    self.entries = collections.OrderedDict() # sha -> (object, size), oldest first
+
+  # get an object and mark it as most recently used
+  def get(self, sha):
+    entry = self.entries.get(sha)
+    if entry is None:
+      if trace:
+        trace.count("object_cache_misses")
+      return None
+
+    if trace:
+      trace.count("object_cache_hits")
+    self.entries.move_to_end(sha)
+    return entry[0]
+
+  # add an object, evicting the least recently used ones until it fits
+  def put(self, sha, obj, size):
+    # objects bigger than the whole cache are not worth keeping
+    if size > self.limit:
+      return
+
+    old = self.entries.pop(sha, None)
+    if old:
+      self.size -= old[1]
+
+    self.entries[sha] = (obj, size)
+    self.size += size
+
+    while self.size > self.limit:
+      _, (_, evicted) = self.entries.popitem(last=False)
+      self.size -= evicted
+      if trace:
+        trace.count("object_cache_evictions")
+
+  # drop everything
+  def clear(self):
+    self.entries.clear()
+    self.size = 0
+
 def repo_path(repo, *path):
   # returns a path by joining the gitdir with the path given as parameter 
   return os.path.join(repo.gitdir, *path)
@@ -128,10 +437,14 @@ def repo_create(path):
   assert repo_dir(repo, "refs", "heads", mkdir=True)
 
   # .git/description
-  # opens the head file as f and writes the description to it
-  with open(repo_file(repo, "HEAD"), "w") as f:
+  # opens the description file as f and writes the description to it
+  with open(repo_file(repo, "description"), "w") as f:
     f.write("Unnamed repository: edit this file 'description' to change the name the repository.\n")
 
+  # .git/HEAD points at the master branch, which has no commit yet
+  with open(repo_file(repo, "HEAD"), "w") as f:
+    f.write("ref: refs/heads/master\n")
+
   # opens the config file and writes the default configuration to it
   with open(repo_file(repo, "config"), "w") as f:
     config = repo_default_config()
@@ -156,20 +469,35 @@ def repo_default_config():
   return ret
 
 # define the init command for the git tracker
-argsp = argsubparsers.add_parser("init", help="Initialize a new, empty repository.")
-
-# add arguments to the init command: path, directory, no args, default case, help message
-argsp.add_argument("path",
-                    metavar="directory",
-                    nargs="?",
-                    default=".",
-                    help="where to create this repository.")
+@command("init", help="Initialize a new, empty repository.")
+def argsp_init(argsp):
+  # add arguments to the init command: path, directory, no args, default case, help message
+  argsp.add_argument("path",
+                      metavar="directory",
+                      nargs="?",
+                      default=".",
+                      help="where to create this repository.")
 
 # create the repo according to the path given by default it is set to the current directory
 # gets called when the init command is called
 def cmd_init(args):
   repo_create(args.path)
 
+# repositories kept open with their caches by wyag serve, worktree -> (config mtime, repo)
+# None outside of the daemon, where every command opens its repository afresh
+repo_cache = None
+
+# open the repository at path, or reuse the one the daemon already has open if its config did not change
+def repo_open(path):
+  if repo_cache is None:
+    return GitRepository(path)
+
+  mtime = path_mtime(os.path.join(path, ".git", "config"))
+  entry = repo_cache.get(path)
+  if entry is None or entry[0] != mtime:
+    entry = repo_cache[path] = (mtime, GitRepository(path))
+  return entry[1]
+
 # recursive function to find the path to the git directory
 def repo_find(path=".", required = True):
   # convert the path to the absolute path
@@ -177,7 +505,7 @@ def repo_find(path=".", required = True):
 
   # check if the path has a git dir if yes then return the new instance of git repo
   if os.path.isdir(os.path.join(path, ".git")):
-    return GitRepository(path)
+    return repo_open(path)
   
   #go up to the parent directory
   parent = os.path.realpath(os.path.join(path, ".."))
@@ -214,48 +542,1048 @@ class GitObject(object):
   def init(self):
     pass
 
-# function to read the repo and ist SHA1 hash
-def object_read(repo, sha):
+# pack entry types as stored in the header of every object inside a packfile
+PACK_OBJ_COMMIT    = 1
+PACK_OBJ_TREE      = 2
+PACK_OBJ_BLOB      = 3
+PACK_OBJ_TAG       = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+# map the non delta pack types to the object formats
+pack_type_fmt = {
+  PACK_OBJ_COMMIT : b'commit',
+  PACK_OBJ_TREE   : b'tree',
+  PACK_OBJ_BLOB   : b'blob',
+  PACK_OBJ_TAG    : b'tag',
+}
+
+# size of the slices of compressed data fed to zlib when inflating a pack entry
+PACK_INFLATE_CHUNK = 64 * 1024
+
+# size of the chunks read, inflated and written when streaming an object
+STREAM_CHUNK = 1024 * 1024
+
+# git packfile with its index, both mapped into memory
+class GitPack(object):
+  """A packfile and its version 2 index"""
+
+  def __init__(self, path):
+    # the index has the same name as the pack with an .idx extension
+    self.path = path
+    self.idx_path = path[:-len(".pack")] + ".idx"
+
+    # map both files read only, the OS pages in only what we touch
+    with open(self.idx_path, "rb") as f:
+      self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(self.path, "rb") as f:
+      self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # view on the pack so compressed data can be handed to zlib without copying
+    self.view = memoryview(self.pack)
+
+    # check the magic numbers and the index version
+    if self.idx[0:4] != b'\xfftOc' or struct.unpack(">I", self.idx[4:8])[0] != 2:
+      raise Exception("Unsupported pack index {0}".format(self.idx_path))
+    if self.pack[0:4] != b'PACK':
+      raise Exception("Malformed pack {0}".format(self.path))
+
+    # fanout table: entry i is the number of objects whose first byte is <= i
+    self.fanout = struct.unpack(">256I", self.idx[8:8 + 256 * 4])
+    self.count = self.fanout[255]
+
+    # the tables that follow the fanout: sorted shas, crc32s, 4 byte offsets and 8 byte offsets
+    self.sha_table = 8 + 256 * 4
+    self.crc_table = self.sha_table + 20 * self.count
+    self.ofs_table = self.crc_table + 4 * self.count
+    self.large_ofs_table = self.ofs_table + 4 * self.count
+
+  # unmap the files
+  def close(self):
+    self.view.release()
+    self.idx.close()
+    self.pack.close()
+
+  # binary sha stored at position i of the index
+  def sha_at(self, i):
+    start = self.sha_table + 20 * i
+    return self.idx[start:start + 20]
+
+  # first position in the index whose sha is >= key, searching only the fanout bucket of its first byte
+  def search(self, key):
+    first = key[0]
+    lo = self.fanout[first - 1] if first else 0
+    hi = self.fanout[first]
+
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.sha_at(mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+
+    return lo
+
+  # pack offset of the object at position i of the index
+  def offset_at(self, i):
+    start = self.ofs_table + 4 * i
+    ofs = struct.unpack(">I", self.idx[start:start + 4])[0]
+
+    # if the msb is set the rest is an index into the 8 byte offset table
+    if ofs & 0x80000000:
+      start = self.large_ofs_table + 8 * (ofs & 0x7fffffff)
+      ofs = struct.unpack(">Q", self.idx[start:start + 8])[0]
+
+    return ofs
+
+  # find the offset of an object in the pack, or None if it is not in this pack
+  def find(self, sha):
+    key = bytes.fromhex(sha)
+    i = self.search(key)
+
+    if i < self.count and self.sha_at(i) == key:
+      return self.offset_at(i)
+    return None
+
+  # all the shas in this pack starting with the given hex prefix
+  def prefix(self, prefix):
+    # pad odd length prefixes so they can be compared as bytes
+    key = bytes.fromhex(prefix if len(prefix) % 2 == 0 else prefix + "0")
+    ret = list()
+
+    i = self.search(key)
+    while i < self.count:
+      sha = self.sha_at(i).hex()
+      if not sha.startswith(prefix):
+        break
+      ret.append(sha)
+      i += 1
+
+    return ret
+
+  # parse the type and inflated size of the entry at offset, returns the position of the data too
+  def entry_header(self, pos):
+    c = self.pack[pos]
+    pos += 1
+
+    # the first byte holds the type in bits 4-6 and the low 4 bits of the size
+    type = (c >> 4) & 7
+    size = c & 0x0f
+    shift = 4
+
+    # the size continues in 7 bit groups as long as the msb is set
+    while c & 0x80:
+      c = self.pack[pos]
+      pos += 1
+      size |= (c & 0x7f) << shift
+      shift += 7
+
+    return type, size, pos
+
+  # inflate the zlib stream starting at pos chunk by chunk, feeding it to zlib in slices of the mapped pack
+  def inflate_iter(self, pos, size):
+    d = zlib.decompressobj()
+
+    # small objects usually fit in a first slice a bit larger than their inflated size
+    chunk = min(size + 64, PACK_INFLATE_CHUNK)
+    while not d.eof:
+      data = self.view[pos:pos + chunk]
+      if not data:
+        raise Exception("Truncated pack {0}".format(self.path))
+      pos += len(data)
+      chunk = PACK_INFLATE_CHUNK
+
+      # bound the output so a highly compressed slice never inflates all at once
+      while data:
+        out = d.decompress(data, STREAM_CHUNK)
+        if out:
+          if trace:
+            trace.count("bytes_inflated", len(out))
+          yield out
+        data = d.unconsumed_tail
+
+  # inflate the whole zlib stream starting at pos
+  def inflate(self, pos, size):
+    data = b''.join(self.inflate_iter(pos, size))
+    if len(data) != size:
+      raise Exception("Malformed pack entry in {0}: bad length".format(self.path))
+    return data
+
+  # format and size of the object at offset without inflating its data
+  def header(self, offset, repo=None):
+    type, size, pos = self.entry_header(offset)
+    result = None
+
+    # the format is the one of the base at the bottom of the chain
+    while type not in pack_type_fmt:
+      if type != PACK_OBJ_OFS_DELTA and type != PACK_OBJ_REF_DELTA:
+        raise Exception("Unknown pack entry type {0} in {1}".format(type, self.path))
+
+      offset, base, pos = self.delta_base(offset, type, pos)
+
+      # the size of the object is the result size of the topmost delta
+      if result is None:
+        result = self.delta_result_size(pos)
+
+      if offset is None:
+        header = object_read_header(repo, base) if repo else None
+        if not header:
+          raise Exception("Missing delta base {0} in {1}".format(base, self.path))
+        return header[0], result
+
+      type, _, pos = self.entry_header(offset)
+
+    return pack_type_fmt[type], size if result is None else result
+
+  # result size of the delta at pos, only the first bytes of the delta are inflated
+  def delta_result_size(self, pos):
+    # two sizes of at most 10 bytes each
+    head = zlib.decompressobj().decompress(self.view[pos:pos + 64], 20)
+    _, i = delta_size(head, 0)
+    return delta_size(head, i)[0]
+
+  # open the object at offset for streaming, returns its format, size and an iterator over its data
+  def stream(self, offset, repo=None):
+    type, size, pos = self.entry_header(offset)
+
+    # full objects are inflated as they are consumed, deltas need their whole base anyway
+    if type in pack_type_fmt:
+      return pack_type_fmt[type], size, stream_check(self.inflate_iter(pos, size), size, self.path)
+
+    fmt, data = self.read(offset, repo)
+    return fmt, len(data), iter([ data ])
+
+  # locate the base of the delta entry at offset whose data starts at pos
+  # returns the offset of the base (None if it is not in this pack), its sha for ref deltas and the position of the delta
+  def delta_base(self, offset, type, pos):
+    if type == PACK_OBJ_OFS_DELTA:
+      # the base is stored as a negative offset from this entry
+      c = self.pack[pos]
+      pos += 1
+      ofs = c & 0x7f
+      while c & 0x80:
+        c = self.pack[pos]
+        pos += 1
+        ofs = ((ofs + 1) << 7) | (c & 0x7f)
+
+      return offset - ofs, None, pos
+
+    # the base is named by its sha, usually in this same pack
+    base = self.pack[pos:pos + 20].hex()
+    return self.find(base), base, pos + 20
+
+  # read the object at offset, resolving delta chains, returns the format and the data
+  def read(self, offset, repo=None):
+    # walk down the chain collecting deltas until we reach a full object
+    deltas = list()
+    while True:
+      type, size, pos = self.entry_header(offset)
+
+      if type == PACK_OBJ_OFS_DELTA or type == PACK_OBJ_REF_DELTA:
+        offset, base, pos = self.delta_base(offset, type, pos)
+        deltas.append(self.inflate(pos, size))
+
+        if offset is None:
+          # the base is stored somewhere else in the repo
+          raw = object_read_raw(repo, base) if repo else None
+          if not raw:
+            raise Exception("Missing delta base {0} in {1}".format(base, self.path))
+          fmt, data = raw
+          break
+
+      elif type in pack_type_fmt:
+        fmt = pack_type_fmt[type]
+        data = self.inflate(pos, size)
+        break
+
+      else:
+        raise Exception("Unknown pack entry type {0} in {1}".format(type, self.path))
+
+    # apply the deltas from the base upwards
+    for delta in reversed(deltas):
+      data = delta_apply(data, delta)
+
+    return fmt, data
+
+# read a little endian base 128 size from a delta
+def delta_size(delta, pos):
+  size = 0
+  shift = 0
+
+  while True:
+    c = delta[pos]
+    pos += 1
+    size |= (c & 0x7f) << shift
+    shift += 7
+    if not c & 0x80:
+      return size, pos
+
+# rebuild an object from its base and a delta
+def delta_apply(base, delta):
+  # the delta starts with the size of the base and the size of the result
+  base_size, pos = delta_size(delta, 0)
+  if base_size != len(base):
+    raise Exception("Delta base size mismatch")
+  result_size, pos = delta_size(delta, pos)
+
+  base = memoryview(base)
+  out = bytearray()
+  end = len(delta)
+
+  while pos < end:
+    op = delta[pos]
+    pos += 1
+
+    if op & 0x80:
+      # copy from the base, the low bits tell which offset and size bytes follow
+      ofs = 0
+      for i in range(4):
+        if op & (1 << i):
+          ofs |= delta[pos] << (8 * i)
+          pos += 1
+
+      size = 0
+      for i in range(3):
+        if op & (0x10 << i):
+          size |= delta[pos] << (8 * i)
+          pos += 1
+
+      # a size of zero means 64k
+      if size == 0:
+        size = 0x10000
+
+      out += base[ofs:ofs + size]
+
+    elif op:
+      # insert the next op bytes of the delta literally
+      out += delta[pos:pos + op]
+      pos += op
+
+    else:
+      raise Exception("Invalid delta opcode 0")
+
+  if len(out) != result_size:
+    raise Exception("Delta result size mismatch")
+
+  return bytes(out)
+
+# size of the blocks of the base indexed when looking for copies
+DELTA_BLOCK = 16
+
+# encode a size as a little endian base 128 number for a delta header
+def delta_size_encode(size):
+  ret = bytearray()
+  while True:
+    c = size & 0x7f
+    size >>= 7
+    if size:
+      ret.append(c | 0x80)
+    else:
+      ret.append(c)
+      return ret
+
+# length of the common run of base[ofs:] and target[pos:], compared a slice at a time
+def delta_match(base, ofs, target, pos, limit):
+  size = 0
+  step = 64
+
+  while size < limit:
+    n = min(step, limit - size)
+    if base[ofs + size:ofs + size + n] == target[pos + size:pos + size + n]:
+      size += n
+    elif step > 1:
+      step //= 8
+    else:
+      break
+
+  return size
+
+# build a delta turning base into target, the inverse of delta_apply
+# with max_size the search gives up and returns None as soon as the delta grows past it, like git's create_delta
+def delta_create(base, target, max_size=0):
+  out = delta_size_encode(len(base)) + delta_size_encode(len(target))
+
+  # index the aligned blocks of the base by their content
+  index = dict()
+  for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+    index.setdefault(base[i:i + DELTA_BLOCK], i)
+
+  insert = bytearray()
+  pos = 0
+  end = len(target)
+
+  while pos < end:
+    ofs = index.get(target[pos:pos + DELTA_BLOCK]) if pos + DELTA_BLOCK <= end else None
+
+    # no match, the byte goes into the next insert op which holds at most 127 bytes
+    if ofs is None:
+      insert.append(target[pos])
+      pos += 1
+      if len(insert) == 0x7f:
+        out.append(len(insert))
+        out += insert
+        insert = bytearray()
+        if max_size and len(out) > max_size:
+          return None
+      continue
+
+    # flush the pending insert before the copy
+    if insert:
+      out.append(len(insert))
+      out += insert
+      insert = bytearray()
+
+    # extend the match as far as it goes, a single copy op holds at most 0xffffff bytes
+    size = delta_match(base, ofs, target, pos, min(len(base) - ofs, end - pos, 0xffffff))
+
+    # copy op: the msb is set and the low bits flag which offset and size bytes follow
+    op = 0x80
+    args = bytearray()
+    for i in range(4):
+      if (ofs >> (8 * i)) & 0xff:
+        op |= 1 << i
+        args.append((ofs >> (8 * i)) & 0xff)
+    for i in range(3):
+      if (size >> (8 * i)) & 0xff:
+        op |= 0x10 << i
+        args.append((size >> (8 * i)) & 0xff)
+
+    out.append(op)
+    out += args
+    pos += size
+    if max_size and len(out) > max_size:
+      return None
+
+  if insert:
+    out.append(len(insert))
+    out += insert
+  if max_size and len(out) > max_size:
+    return None
+
+  return bytes(out)
+
+# list the packs of the repo, mapping them once and rescanning only when objects/pack changes
+def pack_list(repo):
+  path = repo_dir(repo, "objects", "pack")
+  if not path:
+    return []
+
+  mtime = os.stat(path).st_mtime_ns
+  if repo.packs is None or repo.packs_mtime != mtime:
+    # keep the packs we already mapped, map the new ones and close the ones that are gone
+    old = { p.path: p for p in (repo.packs or []) }
+    packs = list()
+
+    for f in sorted(os.listdir(path)):
+      can = os.path.join(path, f)
+      if f.endswith(".pack") and os.path.isfile(can[:-len(".pack")] + ".idx"):
+        packs.append(old.pop(can, None) or GitPack(can))
+
+    for p in old.values():
+      p.close()
+
+    repo.packs = packs
+    repo.packs_mtime = mtime
+
+  return repo.packs
+
+# map the object formats back to the pack types
+pack_fmt_type = { fmt: type for type, fmt in pack_type_fmt.items() }
+
+# encode the type and inflated size header of a pack entry
+def pack_entry_header(type, size):
+  # the first byte holds the type and the low 4 bits of the size, the rest follows in 7 bit groups
+  c = (type << 4) | (size & 0x0f)
+  size >>= 4
+  ret = bytearray()
+
+  while size:
+    ret.append(c | 0x80)
+    c = size & 0x7f
+    size >>= 7
+  ret.append(c)
+
+  return ret
+
+# encode the distance back to the base of an OFS_DELTA entry
+def pack_ofs_encode(ofs):
+  ret = bytearray([ofs & 0x7f])
+  ofs >>= 7
+
+  while ofs:
+    ofs -= 1
+    ret.insert(0, 0x80 | (ofs & 0x7f))
+    ofs >>= 7
+
+  return bytes(ret)
+
+# objects bigger than this are stored whole, never deltified nor used as a base, unless core.bigFileThreshold says otherwise
+# git's default is 512m, the delta search here is too slow to be worth it on blobs that big
+BIG_FILE_THRESHOLD = 16 * 1024 * 1024
+
+# write a version 2 pack and its index holding the given objects
+# objects is a list of (sha, fmt, name, size); bases for deltas are searched in a sliding window
+# returns the path of the new pack and the number of entries stored as deltas
+@traced
+def pack_write(repo, objects, window=10, depth=50):
+  import hashlib
+  path = repo_dir(repo, "objects", "pack", mkdir=True)
+  big = config_size(repo.conf.get("core", "bigfilethreshold", fallback=None), BIG_FILE_THRESHOLD)
+
+  # sort like git so good delta bases end up next to each other: by type, then name, biggest first
+  objects = sorted(objects, key=lambda o: (o[1], o[2], -o[3]))
+
+  tmp = os.path.join(path, "tmp_pack_{0}".format(os.getpid()))
+  h = hashlib.sha1()
+  entries = list() # (sha, crc32, offset)
+  deltas = 0
+  level = repo_compression(repo, "pack")
+
+  with open(tmp, "wb") as f:
+    # write through the hash so the trailer can be computed as we go
+    def put(data):
+      h.update(data)
+      f.write(data)
+
+    put(b'PACK' + struct.pack(">II", 2, len(objects)))
+    offset = 12
+
+    # previous objects of the window: (fmt, data, offset, chain depth)
+    recent = collections.deque(maxlen=window)
+
+    for sha, fmt, name, size in objects:
+      _, data = object_read_raw(repo, sha)
+
+      # try every base in the window and keep the smallest delta, if it saves enough
+      # a delta has to be smaller than half the object and than the best one so far, the search stops past that
+      best = None
+      for base_fmt, base_data, base_offset, base_depth in recent if len(data) <= big else ():
+        if base_fmt != fmt or base_depth >= depth:
+          continue
+        # sizes too far apart rarely give a useful delta
+        if len(base_data) < len(data) // 32:
+          continue
+        max_size = len(best[0]) - 1 if best else len(data) // 2 - 21
+        if max_size <= 0:
+          break
+        delta = delta_create(base_data, data, max_size)
+        if delta is not None:
+          best = (delta, base_offset, base_depth)
+
+      if best:
+        delta, base_offset, base_depth = best
+        entry = pack_entry_header(PACK_OBJ_OFS_DELTA, len(delta)) + pack_ofs_encode(offset - base_offset) + zlib.compress(delta, level)
+        chain = base_depth + 1
+        deltas += 1
+      else:
+        entry = pack_entry_header(pack_fmt_type[fmt], len(data)) + zlib.compress(data, level)
+        chain = 0
+
+      if trace:
+        trace.count("objects_packed")
+        trace.count("bytes_deflated", len(delta) if best else len(data))
+
+      put(entry)
+      entries.append((bytes.fromhex(sha), zlib.crc32(entry), offset))
+      if len(data) <= big:
+        recent.append((fmt, data, offset, chain))
+      offset += len(entry)
+
+    # the trailer is the sha of everything before it
+    checksum = h.digest()
+    f.write(checksum)
+
+  # the index lists the objects sorted by sha
+  entries.sort()
+  idx = bytearray(b'\xfftOc' + struct.pack(">I", 2))
+
+  # fanout table: number of objects whose first byte is <= i
+  counts = [0] * 256
+  for sha, _, _ in entries:
+    counts[sha[0]] += 1
+  total = 0
+  for i in range(256):
+    total += counts[i]
+    idx += struct.pack(">I", total)
+
+  for sha, _, _ in entries:
+    idx += sha
+  for _, crc, _ in entries:
+    idx += struct.pack(">I", crc)
+
+  # offsets that do not fit in 31 bits go to the 8 byte table
+  large = list()
+  for _, _, ofs in entries:
+    if ofs < 0x80000000:
+      idx += struct.pack(">I", ofs)
+    else:
+      idx += struct.pack(">I", 0x80000000 | len(large))
+      large.append(ofs)
+  for ofs in large:
+    idx += struct.pack(">Q", ofs)
+
+  idx += checksum
+  idx += hashlib.sha1(idx).digest()
+
+  # name the pack after its checksum, the index goes in first so readers never see a pack without one
+  name = os.path.join(path, "pack-" + checksum.hex())
+  with open(tmp + ".idx", "wb") as f:
+    f.write(idx)
+    if repo_fsync(repo, "pack-metadata"):
+      f.flush()
+      os.fsync(f.fileno())
+  if repo_fsync(repo, "pack"):
+    with open(tmp, "rb") as f:
+      os.fsync(f.fileno())
+  os.rename(tmp + ".idx", name + ".idx")
+  os.rename(tmp, name + ".pack")
+  if repo_fsync(repo, "pack") or repo_fsync(repo, "pack-metadata"):
+    fsync_dir(path)
+
+  return name + ".pack", deltas
+
+# read the format and data of an object, looking in the packs first and the loose objects after
+def object_read_raw(repo, sha):
+  if trace:
+    trace.count("objects_read")
+
+  for pack in pack_list(repo):
+    offset = pack.find(sha)
+    if offset is not None:
+      return pack.read(offset, repo)
+
   # get the path to the object first two bits of the sha hash denote the directory and rest denote the file
-  path = repo_file(repo, "objects", sha[0:2], sha[2:])
+  path = object_loose_path(repo, sha)
 
   # check if the file exists or not
-  if not os.path.isfile(path):
+  if not path or not os.path.isfile(path):
     return None
-  
+
   # open the file in read binary mode and decompress the file
   with open(path , "rb") as f:
     raw = zlib.decompress(f.read())
+  if trace:
+    trace.count("bytes_inflated", len(raw))
 
-    # find the first space in the file  
-    x = raw.find(b' ')
-    # get the object type 
-    fmt = raw[0:x]
+  # find the first space in the file
+  x = raw.find(b' ')
+  # get the object type
+  fmt = raw[0:x]
 
-    # find the null byte
-    y = raw.find(b'\x100', x)
-    # get the size of the object by decoding the ascii value
-    size = int(raw[x:y].decode("ascii"))
+  # find the null byte
+  y = raw.find(b'\x00', x)
+  # get the size of the object by decoding the ascii value
+  size = int(raw[x:y].decode("ascii"))
+
+  # check if the size is equal to the length of the raw file
+  if size != len(raw)-y-1:
+    raise Exception("Malformed Object {0}: bad length".format(sha))
+
+  # return the object type and the data except the header
+  return fmt, raw[y+1:]
+
+# inflate a loose object file chunk by chunk, header included
+def loose_inflate_iter(path):
+  with open(path, "rb") as f:
+    d = zlib.decompressobj()
+
+    while not d.eof:
+      data = f.read(STREAM_CHUNK)
+      if not data:
+        raise Exception("Truncated object {0}".format(path))
+
+      # bound the output so a highly compressed chunk never inflates all at once
+      while data:
+        out = d.decompress(data, STREAM_CHUNK)
+        if out:
+          if trace:
+            trace.count("bytes_inflated", len(out))
+          yield out
+        data = d.unconsumed_tail
+
+# pass the chunks of a stream through, checking that they add up to the announced size
+def stream_check(chunks, size, name):
+  total = 0
+  for chunk in chunks:
+    total += len(chunk)
+    yield chunk
+
+  if total != size:
+    raise Exception("Malformed Object {0}: bad length".format(name))
+
+# format and size of an object, inflating only its header
+def object_read_header(repo, sha):
+  if trace:
+    trace.count("headers_read")
+
+  for pack in pack_list(repo):
+    offset = pack.find(sha)
+    if offset is not None:
+      return pack.header(offset, repo)
+
+  path = object_loose_path(repo, sha)
+  if not path or not os.path.isfile(path):
+    return None
+
+  with open(path, "rb") as f:
+    d = zlib.decompressobj()
+    head = b''
+    data = b''
+
+    # the header "<type> <size>\0" fits in a few dozen bytes
+    while b'\x00' not in head:
+      if len(head) > 64:
+        raise Exception("Malformed Object {0}: bad header".format(sha))
+      if not data:
+        data = f.read(64)
+        if not data:
+          raise Exception("Malformed Object {0}: bad header".format(sha))
+      head += d.decompress(data, 64)
+      data = d.unconsumed_tail
+
+  x = head.find(b' ')
+  y = head.find(b'\x00', x)
+  return head[0:x], int(head[x:y].decode("ascii"))
+
+# check if an object is stored in the repo, packed or loose
+def object_exists(repo, sha):
+  return sha in object_set(repo)
+
+# objects known to exist, so writes and existence checks do not probe the disk for every object
+# packed objects are looked up in the mapped indexes, loose ones in a set seeded by listing
+# each fanout directory once and kept up to date by our own writes
+class GitObjectSet(object):
+  """Existence of the objects of a repository"""
+
+  def __init__(self, repo):
+    self.repo = repo
+    self.loose = set()  # binary shas of loose objects
+    self.listed = set() # first bytes of the fanout directories already listed
+
+  def __contains__(self, sha):
+    key = bytes.fromhex(sha)
+    if key in self.loose:
+      return True
+
+    for pack in pack_list(self.repo):
+      i = pack.search(key)
+      if i < pack.count and pack.sha_at(i) == key:
+        return True
+
+    # first lookup in this fanout directory, one listing instead of a stat per object
+    if key[0] not in self.listed:
+      self.listed.add(key[0])
+      name = "{0:02x}".format(key[0])
+      path = repo_path(self.repo, "objects", name)
+      if os.path.isdir(path):
+        for f in os.listdir(path):
+          if len(f) == 38:
+            try:
+              self.loose.add(bytes.fromhex(name + f))
+            except ValueError:
+              pass
+      if key in self.loose:
+        return True
+
+    # another process may have written it since the listing
+    path = repo_path(self.repo, "objects", sha[0:2], sha[2:])
+    if os.path.isfile(path):
+      self.loose.add(key)
+      return True
+    return False
+
+  # record an object we just wrote
+  def add(self, sha):
+    self.loose.add(bytes.fromhex(sha))
+
+# the object set of the repo
+def object_set(repo):
+  if repo.objects is None:
+    repo.objects = GitObjectSet(repo)
+  return repo.objects
+
+# components of core.fsync, and the aggregate names standing for several of them
+FSYNC_COMPONENTS = [ "loose-object", "pack", "pack-metadata", "commit-graph", "index", "reference" ]
+FSYNC_AGGREGATES = {
+  "objects": [ "loose-object", "pack" ],
+  "derived-metadata": [ "pack-metadata", "commit-graph" ],
+  "committed": [ "loose-object", "pack", "reference" ],
+  "added": [ "loose-object", "pack", "reference", "index" ],
+  "all": FSYNC_COMPONENTS,
+  "none": [],
+}
+
+# git syncs only packs, their metadata and the commit-graph unless told otherwise
+FSYNC_DEFAULT = [ "pack", "pack-metadata", "commit-graph" ]
+
+# the components whose writes are made durable, core.fsync is a comma separated list where "-x" removes x
+def fsync_components(conf):
+  value = conf.get("core", "fsync", fallback=None)
+  if value is None:
+    ret = set(FSYNC_DEFAULT)
+    # the older setting for loose objects
+    if conf.getboolean("core", "fsyncobjectfiles", fallback=False):
+      ret.add("loose-object")
+    return ret
+
+  items = [ i.strip().lower() for i in value.split(",") if i.strip() ]
+  # a list of removals only applies to the default
+  ret = set(FSYNC_DEFAULT) if items and all(i.startswith("-") for i in items) else set()
+  for item in items:
+    names = FSYNC_AGGREGATES.get(item.lstrip("-"), [ item.lstrip("-") ])
+    if item.startswith("-"):
+      ret.difference_update(names)
+    else:
+      ret.update(names)
+  return ret
+
+# whether writes of a component have to be made durable
+def repo_fsync(repo, component):
+  if repo.fsync is None:
+    repo.fsync = fsync_components(repo.conf)
+  return component in repo.fsync
+
+# sync a file written under a lock or temporary name before it is renamed into place
+# like git only the data is synced, a crash before the directory is synced leaves the old file in place
+def repo_fsync_file(repo, component, f):
+  if repo_fsync(repo, component):
+    f.flush()
+    os.fsync(f.fileno())
+
+# make the entries of a directory durable, the names of files renamed or created in it
+def fsync_dir(path):
+  fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+# a file written under path.lock, created exclusively so two writers never both think they hold it,
+# renamed over path when the block ends and removed when it raises or is cancelled
+# when the lock is not required and another process holds it, the block gets None instead of a file
+class GitLockFile(object):
+  """Exclusive lock file renamed into place"""
+
+  def __init__(self, path, mode="wb", required=True):
+    self.path = path
+    self.lock = path + ".lock"
+    self.mode = mode
+    self.required = required
+    self.file = None
+    self.cancelled = False
+
+  def __enter__(self):
+    try:
+      fd = os.open(self.lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+    except FileExistsError:
+      if not self.required:
+        return None
+      raise Exception("Unable to create {0}: File exists. Another wyag or git process seems to be running.".format(self.lock))
+    self.file = os.fdopen(fd, self.mode)
+    return self.file
+
+  # drop the lock file instead of renaming it when the block ends
+  def cancel(self):
+    self.cancelled = True
+
+  def __exit__(self, type, value, tb):
+    if self.file is None:
+      return False
+    try:
+      self.file.close()
+      if type is None and not self.cancelled:
+        os.rename(self.lock, self.path)
+        return False
+    except BaseException:
+      os.unlink(self.lock)
+      raise
+    os.unlink(self.lock)
+    return False
+
+# sync_file_range of the c library, loaded on first use, False where there is none
+libc_sync_file_range = None
+
+# flags of sync_file_range: wait for writes already started, then start writing the range
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+
+# hand the data of a file to the drive without waiting for it to reach stable storage, git's writeout-only fsync
+# a later fsync of any file of the filesystem flushes the drive cache and makes it durable
+# a full fsync where sync_file_range does not exist
+def fsync_writeout(fd):
+  global libc_sync_file_range
+  if libc_sync_file_range is None:
+    import ctypes
+    import ctypes.util
+    try:
+      fn = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).sync_file_range
+      fn.argtypes = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint ]
+      libc_sync_file_range = fn
+    except (OSError, AttributeError):
+      libc_sync_file_range = False
+
+  if not libc_sync_file_range or libc_sync_file_range(fd, 0, 0, SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE) != 0:
+    os.fsync(fd)
+
+# path of a loose object, objects of a write batch in progress are still in their temporary file
+def object_loose_path(repo, sha):
+  if repo.batch and sha in repo.batch.pending:
+    return repo.batch.pending[sha]
+  return repo_file(repo, "objects", sha[0:2], sha[2:])
+
+# sync a temporary object file being written, in a batch only its writeout is started and the batch waits for it
+def object_sync(repo, f):
+  if repo_fsync(repo, "loose-object"):
+    f.flush()
+    if repo.batch:
+      fsync_writeout(f.fileno())
+    else:
+      os.fsync(f.fileno())
+
+# move a written temporary object file to its place
+def object_store(repo, sha, tmp):
+  object_set(repo).add(sha)
+  if trace:
+    trace.count("objects_written")
+
+  # a batch renames its objects when it is done
+  if repo.batch:
+    repo.batch.pending[sha] = tmp
+    return
+
+  objects = repo_path(repo, "objects")
+  created = not os.path.isdir(os.path.join(objects, sha[0:2]))
+  path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+  os.rename(tmp, path)
+
+  if repo_fsync(repo, "loose-object"):
+    fsync_dir(os.path.dirname(path))
+    if created:
+      fsync_dir(objects)
+
+# objects written in a batch stay in their temporary files, written out but invisible under their name,
+# until the batch ends: one fsync flushes the drive cache and makes all their data durable, then they are
+# renamed into place and every directory that got a new name is synced once, instead of three syncs per object
+# without core.fsyncMethod=batch, or when loose objects are not synced at all, writes go straight to their place
+class GitWriteBatch(object):
+  """Object writes made durable together"""
+
+  def __init__(self, repo):
+    self.repo = repo
+    self.pending = dict() # sha -> temporary file of the objects written in the batch
+
+  def __enter__(self):
+    repo = self.repo
+    method = repo.conf.get("core", "fsyncmethod", fallback="fsync").lower()
+
+    # nested batches are part of the outermost one
+    if repo.batch is None and method == "batch" and repo_fsync(repo, "loose-object"):
+      repo.batch = self
+    return self
+
+  def __exit__(self, type, value, tb):
+    # the objects written before an error are valid all the same
+    if self.repo.batch is self:
+      self.repo.batch = None
+      self.commit()
+    return False
+
+  def commit(self):
+    if not self.pending:
+      return
+
+    # the data first, so no object is ever visible before its content is on disk
+    # the objects were written out as they were written, an fsync of a new empty file is the flush they wait for
+    import tempfile
+    objects = repo_path(self.repo, "objects")
+    fd, barrier = tempfile.mkstemp(dir=objects, prefix="tmp_barrier_")
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+      os.unlink(barrier)
+    dirs = set()
+    for sha, tmp in self.pending.items():
+      if not os.path.isdir(os.path.join(objects, sha[0:2])):
+        dirs.add(objects)
+      path = repo_file(self.repo, "objects", sha[0:2], sha[2:], mkdir=True)
+      os.rename(tmp, path)
+      dirs.add(os.path.dirname(path))
+
+    for path in dirs:
+      fsync_dir(path)
+
+    self.pending.clear()
+
+# open an object for streaming, returns its format, size and an iterator over its data
+def object_read_stream(repo, sha):
+  if trace:
+    trace.count("objects_read")
+
+  for pack in pack_list(repo):
+    offset = pack.find(sha)
+    if offset is not None:
+      return pack.stream(offset, repo)
+
+  path = object_loose_path(repo, sha)
+  if not path or not os.path.isfile(path):
+    return None
+
+  # inflate until the whole header is in
+  chunks = loose_inflate_iter(path)
+  head = b''
+  while b'\x00' not in head:
+    chunk = next(chunks, None)
+    if chunk is None:
+      raise Exception("Malformed Object {0}: bad header".format(sha))
+    head += chunk
+
+  # split the header "<type> <size>\0" from the first bytes of the data
+  x = head.find(b' ')
+  y = head.find(b'\x00', x)
+  fmt = head[0:x]
+  size = int(head[x:y].decode("ascii"))
+
+  def data():
+    yield head[y+1:]
+    yield from chunks
+
+  return fmt, size, stream_check(data(), size, sha)
+
+# function to read the repo and ist SHA1 hash
+def object_read(repo, sha):
+  # repeated traversals find the parsed object in the cache
+  obj = repo.object_cache.get(sha)
+  if obj is not None:
+    return obj
+
+  raw = object_read_raw(repo, sha)
+
+  # check if the object exists or not
+  if raw is None:
+    return None
+
+  fmt, data = raw
+
+  # match the object type
+  match fmt:
+    case b'commit' : c=GitCommit
+    case b'tree'   : c=GitTree
+    case b'tag'    : c=GitTag
+    case b'blob'   : c=GitBlob
+    case _:
+      raise Exception("Unkown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+
+  # return the required git object initialized with the data
+  obj = c(data)
+  repo.object_cache.put(sha, obj, len(data))
+  return obj
 
-    # check if the size is equal to the length of the raw file
-    if size != len(raw)-y-1:
-      raise Exception("Malformed Object {0}: bad length".format(sha))
-    
-    # match the object type
-    match fmt:
-      case b'commit' : c=GitCommit
-      case b'tree'   : c=GitTree
-      case b'tag'    : c=GitTag
-      case b'blob'   : c=GitBlob
-      case _:
-        raise Exception("Unkown type {0} for object {1}".format(fmt.decode("ascii"), sha))
-    
-    # return the required git object initialized with the data except the header
-    return c(raw[y+1:])
-  
 # function for writing the object to the repo
 def object_write(obj, repo=None):
-  data = obj.serialize
+  import hashlib
+  import tempfile
+  data = obj.serialize()
 
   # construct the header for the object with its object type, space, length of the data as a string, null byte, and data 
   result = obj.fmt + b' ' + str(len(data)).encode()+ b'\x00' + data
@@ -263,16 +1591,19 @@ def object_write(obj, repo=None):
   # compute the sha1 hash of the result into hexadecimal
   sha = hashlib.sha1(result).hexdigest()
 
-  # if repo is provided then write the object to the repo
-  if repo:
-    # construct the path to the object
-    path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
-
-    # check if the file exists or not
-    if not os.path.exists(path):
-      with open(path, 'wb') as f:
-        # write the compressed data to the file
-        f.write(zlib.compress(result))
+  # if repo is provided then write the object to the repo, unless it is already there loose or packed
+  if repo and not object_exists(repo, sha):
+    # write to a temporary file first so a crash never leaves a truncated object behind
+    fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_dir(repo, "objects", mkdir=True))
+    # mkstemp creates the file 0600, objects are read only for everyone like git makes them
+    os.fchmod(fd, 0o444)
+    with os.fdopen(fd, 'wb') as f:
+      # write the compressed data to the file
+      f.write(zlib.compress(result, repo_compression(repo, "loose")))
+      if trace:
+        trace.count("bytes_deflated", len(result))
+      object_sync(repo, f)
+    object_store(repo, sha, tmp)
   
   # return the sha1 hash of the object
   return sha
@@ -291,49 +1622,178 @@ class GitBlob(GitObject):
     self.blobdata = data
 
 # catfile command in the cmdline
-argsp = argsubparsers.add_parser("cat-file", help="Help provide the details about the contents")
-
-# add the arguments to the cmd of object type and the object itself to display
-argsp.add_argument("type",
-                   metavar="type",
-                   choices=["blob","commit","tag","tree"],
-                   help="Specify the type")
-
-argsp.add_argument("object",
-                   metavar="object",
-                   help="object to display")
+@command("cat-file", help="Help provide the details about the contents")
+def argsp_cat_file(argsp):
+  # add the arguments to the cmd of object type and the object itself to display
+  argsp.add_argument("type",
+                     metavar="type",
+                     nargs="?",
+                     help="Specify the type")
+
+  argsp.add_argument("object",
+                     metavar="object",
+                     nargs="?",
+                     help="object to display")
+
+  # show only the type or the size, read from the object header
+  argsp.add_argument("-t",
+                     dest="show_type",
+                     action="store_true",
+                     help="Show the object type instead of its content")
+
+  argsp.add_argument("-s",
+                     dest="show_size",
+                     action="store_true",
+                     help="Show the object size instead of its content")
+
+  # batch modes reading object names from stdin
+  argsp.add_argument("--batch",
+                     action="store_true",
+                     help="Print the header and content of each object named on stdin")
+
+  argsp.add_argument("--batch-check",
+                     dest="batch_check",
+                     action="store_true",
+                     help="Print the header of each object named on stdin")
+
+  argsp.add_argument("--batch-exists",
+                     dest="batch_exists",
+                     action="store_true",
+                     help="Print whether each object named on stdin exists, without reading it")
 
 # wrapper for the catfile command
 def cmd_cat_file(args):
   repo = repo_find()
-  cat_file(repo, args.object, fmt=args.type.encode())
 
-# function to display the contents of the object
+  if args.batch_exists:
+    cat_file_batch_exists(repo, sys.stdin.buffer)
+    return
+  if args.batch or args.batch_check:
+    cat_file_batch(repo, sys.stdin.buffer, contents=args.batch)
+    return
+
+  # with a single positional argument it is the object
+  if args.object is None:
+    args.type, args.object = None, args.type
+  if args.object is None:
+    raise Exception("cat-file needs an object")
+  if args.type and args.type not in ["blob", "commit", "tag", "tree"]:
+    raise Exception("Unknown type {0}".format(args.type))
+
+  if args.show_type or args.show_size:
+    cat_file_header(repo, args.object, show_type=args.show_type)
+  elif args.type:
+    cat_file(repo, args.object, fmt=args.type.encode())
+  else:
+    raise Exception("cat-file needs a type, -t or -s")
+
+# function to display the contents of the object, streamed so blobs never sit whole in memory
 def cat_file(repo, object, fmt=None):
-  obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-  sys.stdout.buffer.write(obj.serialize())
+  sha = object_find(repo, object, fmt=fmt)
+  _, _, data = object_read_stream(repo, sha)
+
+  for chunk in data:
+    sys.stdout.buffer.write(chunk)
+
+# answer a stream of object names, one per line, with "<sha> <type> <size>" and optionally the content
+# the repository and its caches are shared by every request
+def cat_file_batch(repo, lines, contents=True):
+  out = sys.stdout.buffer
+
+  for line in lines:
+    name = line.rstrip(b'\r\n').decode("utf8")
+    if not name:
+      continue
+
+    candidates = object_resolve(repo, name)
+    if candidates and len(candidates) > 1:
+      out.write(name.encode("utf8") + b' ambiguous\n')
+      out.flush()
+      continue
+
+    sha = candidates[0] if candidates else None
+    header = object_read_header(repo, sha) if sha else None
+    if not header:
+      out.write(name.encode("utf8") + b' missing\n')
+      out.flush()
+      continue
+
+    fmt, size = header
+    out.write("{0} {1} {2}\n".format(sha, fmt.decode("ascii"), size).encode("ascii"))
+
+    # the content is followed by a newline so records can be split without parsing sizes
+    if contents:
+      _, _, data = object_read_stream(repo, sha)
+      for chunk in data:
+        out.write(chunk)
+      out.write(b'\n')
+
+    # flush after every record so a caller can wait for the answer before sending the next name
+    out.flush()
+
+# answer a stream of object names with "<sha> exists" or "<name> missing"
+# full shas only go through the object set, other names are resolved first
+def cat_file_batch_exists(repo, lines):
+  out = sys.stdout.buffer
+  objects = object_set(repo)
+  full = re.compile(r"^[0-9a-f]{40}$")
+
+  for line in lines:
+    name = line.rstrip(b'\r\n').decode("utf8")
+    if not name:
+      continue
+
+    if full.match(name):
+      sha = name if name in objects else None
+    else:
+      candidates = object_resolve(repo, name)
+      if candidates and len(candidates) > 1:
+        out.write(name.encode("utf8") + b' ambiguous\n')
+        out.flush()
+        continue
+      sha = candidates[0] if candidates and candidates[0] in objects else None
+
+    out.write("{0} exists\n".format(sha).encode("ascii") if sha else name.encode("utf8") + b' missing\n')
+    out.flush()
+
+# function to display the type or the size of the object
+def cat_file_header(repo, object, show_type=True):
+  fmt, size = object_read_header(repo, object_find(repo, object))
+  print(fmt.decode("ascii") if show_type else size)
 
 # function to find the object
 def object_find(repo, name, fmt=None, follow=True):
   return name
 
 # hash-object command in the cmdline
-argsp = argsubparsers.add_parser("hash-object", help="Compute object ID and optionally creates a blob from file")
-
-# add the arguments to the cmd of type and write
-argsp.add_argument("-t",
-                   metavar="type",
-                   choices=["blob","commit","tag","tree"],
-                    default="blob",
-                    help="Specify the type")
-
-argsp.add_argument("-w",
-                   dest="write",
-                   action="store_true",
-                   help="Actually write the object into the database")
-
-# add path argument
-argsp.add_argument("path", help="Read object from <file>")
+@command("hash-object", help="Compute object ID and optionally creates a blob from file")
+def argsp_hash_object(argsp):
+  # add the arguments to the cmd of type and write
+  argsp.add_argument("-t",
+                     metavar="type",
+                     dest="type",
+                     choices=["blob","commit","tag","tree"],
+                      default="blob",
+                      help="Specify the type")
+
+  argsp.add_argument("-w",
+                     dest="write",
+                     action="store_true",
+                     help="Actually write the object into the database")
+
+  argsp.add_argument("--stdin-paths",
+                     dest="stdin_paths",
+                     action="store_true",
+                     help="Read file names from stdin, one per line")
+
+  argsp.add_argument("-j",
+                     dest="jobs",
+                     type=int,
+                     default=os.cpu_count(),
+                     help="Number of worker processes")
+
+  # add path argument
+  argsp.add_argument("path", nargs="*", help="Read object from <file>")
 
 # wrapper for the hash-object command
 def cmd_hash_object(args):
@@ -343,13 +1803,70 @@ def cmd_hash_object(args):
   else: 
     repo = None
 
-  # open the file in read binary mode and compute the sha1 hash of the object and print it
-  with open(args.path, "rb") as fd:
-    sha = object_hash(fd, args.type.encode(), repo)
+  paths = list(args.path)
+  if args.stdin_paths:
+    paths += [ line.rstrip("\r\n") for line in sys.stdin if line.rstrip("\r\n") ]
+
+  # the shas come out in the order of the paths
+  for sha in object_hash_paths(paths, args.type.encode(), repo, jobs=args.jobs):
     print(sha)
 
+# repository of the hash-object worker processes
+hash_worker_repo = None
+
+# set up a hash-object worker process with its own view of the repo
+def hash_worker_init(worktree):
+  global hash_worker_repo
+  hash_worker_repo = GitRepository(worktree) if worktree else None
+
+# number of files a hash-object worker hashes in one write batch
+HASH_CHUNK = 64
+
+# hash a chunk of files in a worker process, their objects are synced together
+def hash_worker(paths, fmt):
+  if not hash_worker_repo:
+    return [ object_hash_path(path, fmt) for path in paths ]
+
+  with hash_worker_repo.write_batch():
+    return [ object_hash_path(path, fmt, hash_worker_repo) for path in paths ]
+
+# hash a file and write it to the repo unless the object is already there
+def object_hash_path(path, fmt, repo=None):
+  with open(path, "rb") as fd:
+    return object_hash(fd, fmt, repo)
+
+# hash many files, spreading the work over a pool of processes
+def object_hash_paths(paths, fmt, repo=None, jobs=None):
+  import concurrent.futures
+  if not jobs or jobs < 2 or len(paths) < 2:
+    if not repo:
+      return [ object_hash_path(path, fmt) for path in paths ]
+    with repo.write_batch():
+      return [ object_hash_path(path, fmt, repo) for path in paths ]
+
+  # the same path listed twice is only hashed once
+  unique = list(dict.fromkeys(paths))
+  worktree = repo.worktree if repo else None
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=hash_worker_init, initargs=(worktree,)) as pool:
+    # map keeps the results in the order of the input, chunks cut down on pickling round trips and syncs
+    chunks = [ unique[i:i + HASH_CHUNK] for i in range(0, len(unique), HASH_CHUNK) ]
+    results = itertools.chain.from_iterable(pool.map(hash_worker, chunks, itertools.repeat(fmt)))
+    shas = dict(zip(unique, results))
+
+  return [ shas[path] for path in paths ]
+
+# blobs of regular files bigger than this are streamed instead of read whole
+HASH_STREAM_THRESHOLD = 32 * 1024 * 1024
+
 # function to hash the object
 def object_hash(fd, fmt, repo=None):
+  # big blobs in regular files are streamed in one pass, their size is known up front
+  # smaller ones are read whole so their sha is known before anything is compressed and stored content is skipped
+  st = os.fstat(fd.fileno())
+  if fmt == b'blob' and stat.S_ISREG(st.st_mode) and st.st_size > HASH_STREAM_THRESHOLD:
+    return object_hash_stream(fd, fmt, repo)
+
   # read the data from the file
   data = fd.read()
 
@@ -364,6 +1881,61 @@ def object_hash(fd, fmt, repo=None):
   # if repo is provided then write the object to the repo
   return object_write(obj, repo)
 
+# hash a regular file chunk by chunk, compressing it into a temporary file renamed into place
+def object_hash_stream(fd, fmt, repo=None):
+  import hashlib
+  import tempfile
+  # the header needs the size before any data is read
+  size = os.fstat(fd.fileno()).st_size
+  header = fmt + b' ' + str(size).encode() + b'\x00'
+  h = hashlib.sha1(header)
+
+  if repo:
+    tmp_fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_dir(repo, "objects", mkdir=True))
+    os.fchmod(tmp_fd, 0o444)
+    out = os.fdopen(tmp_fd, "wb")
+    z = zlib.compressobj(repo_compression(repo, "loose"))
+    out.write(z.compress(header))
+    if trace:
+      trace.count("bytes_deflated", size + len(header))
+
+  try:
+    total = 0
+    while True:
+      chunk = fd.read(STREAM_CHUNK)
+      if not chunk:
+        break
+      total += len(chunk)
+      h.update(chunk)
+      if repo:
+        out.write(z.compress(chunk))
+
+    if total != size:
+      raise Exception("File changed while hashing it")
+
+    sha = h.hexdigest()
+
+    if repo:
+      out.write(z.flush())
+
+      # move the object into place unless we already have it
+      if object_exists(repo, sha):
+        out.close()
+        os.remove(tmp)
+      else:
+        object_sync(repo, out)
+        out.close()
+        object_store(repo, sha, tmp)
+
+  except:
+    if repo:
+      out.close()
+      if os.path.exists(tmp):
+        os.remove(tmp)
+    raise
+
+  return sha
+
 # function for key value list mapping
 def kvlm_parse(raw, start=0, dct=None):
   # if the dictionary is not provided then create an ordered dictionary
@@ -395,7 +1967,7 @@ def kvlm_parse(raw, start=0, dct=None):
 
   # if the key is already present in the dictionary then append the value to the key
   if key in dct:
-    if type(dct[key] == list):
+    if type(dct[key]) == list:
       dct[key].append(value)
     else: 
       dct[key] = [ dct[key], value ]
@@ -434,7 +2006,7 @@ class GitCommit(GitObject):
     self.kvlm = kvlm_parse(data)
   
   # serialize the object  
-  def serialize(self, repo):
+  def serialize(self):
     return kvlm_serialize(self.kvlm)
   
   # constructor function
@@ -442,109 +2014,459 @@ class GitCommit(GitObject):
     self.kvlm = dict()
 
 # log command in the cmdline
-argsp = argsubparsers.add_parser("log", help="Display history of a given commit")
-
-argsp.add_argument("commit",
-                    default="HEAD",
-                    nargs="?",
-                    help="Commit to start at")
+@command("log", help="Display history of a given commit")
+def argsp_log(argsp):
+  argsp.add_argument("commit",
+                      default="HEAD",
+                      nargs="?",
+                      help="Commit to start at")
+
+  argsp.add_argument("-n", "--max-count",
+                      dest="max_count",
+                      type=int,
+                      default=None,
+                      help="Show at most this many commits")
+
+  argsp.add_argument("--since",
+                      default=None,
+                      help="Show commits more recent than this date")
+
+  argsp.add_argument("--until",
+                      default=None,
+                      help="Show commits older than this date")
+
+  argsp.add_argument("--oneline",
+                      action="store_true",
+                      help="Print one line per commit instead of a graphviz graph")
 
 def cmd_log(args):
   repo = repo_find()
 
-  # print the graphviz of the log
-  print("digraph wyaglog{")
-  print("  node[shape=rect]")
-  # pass the repo, sha1 hash and a set to keep the record of visited commits
-  log_graphviz(repo, object_find(repo, args.commit), set())
-  print("}")
+  since = log_date(args.since) if args.since else None
+  until = log_date(args.until) if args.until else None
 
-def log_graphviz(repo, sha, seen):
+  # commits are produced lazily, newest first, so -n only pays for what it shows
+  commits = log_walk(repo, [ object_find(repo, args.commit, fmt=b'commit') ], since=since, until=until)
+  if args.max_count is not None:
+    commits = itertools.islice(commits, args.max_count)
 
-  # check if the commit has been visited already
-  if sha in seen:
+  if args.oneline:
+    for sha in commits:
+      print("{0} {1}".format(sha[0:7], commit_summary(object_read(repo, sha))))
     return
-  
-  # add the commit to the seen set
-  seen.add(sha)
 
-  # get commit object
-  commit = object_read(repo, sha)
-
-  # short version of hash for display purposes
-  short_hash = sha[0:8]
+  # print the graphviz of the log
+  print("digraph wyaglog{")
+  print("  node[shape=rect]")
+  log_graphviz(repo, commits)
+  print("}")
 
+# parse a date given to --since or --until into a unix timestamp
+# accepts timestamps, iso dates and "<n> <unit>s ago"
+def log_date(value):
+  from datetime import datetime
+  value = value.strip()
+  if value.isdigit():
+    return int(value)
+
+  m = re.match(r"^(\d+)\s*(second|minute|hour|day|week|month|year)s?\s+ago$", value)
+  if m:
+    units = { "second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 7 * 86400, "month": 30 * 86400, "year": 365 * 86400 }
+    return int(time.time()) - int(m.group(1)) * units[m.group(2)]
+
+  date = datetime.fromisoformat(value)
+  # dates without a timezone are local time
+  if date.tzinfo is None:
+    date = date.astimezone()
+  return int(date.timestamp())
+
+# first line of a commit message
+def commit_summary(commit):
   # get the commit message from the commit object ans remove any spaces or newlines
   message = commit.kvlm[None].decode("utf8").strip()
 
-  # escape the backslashes and double quotes
-  message = message.replace("\\", "\\\\")
-  message = message.replace("\"", "\\\"")
-
   # only take the first line of the message
   if("\n" in message):
     message = message[:message.find("\n")]
-    
-  # print the commit node with its short hash and message
-  print(" c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
-  
-  # check the format of the commit object for correctness
-  assert commit.fmt == b'commit'
 
-  # check for parent
-  if not b'parent' in commit.kvlm.keys():
-    return
-  
+  return message
+
+# walk the history from the given commits, newest committer date first
+# the walk is a generator so the caller decides how much of the history is visited
+def log_walk(repo, shas, since=None, until=None):
+  graph = commit_graph(repo)
+
+  # the date comes from the commit-graph when it has the commit
+  def date(sha):
+    i = graph.index(sha) if graph else None
+    if i is not None:
+      return graph.generation_date(i)[1]
+    return commit_date(object_read(repo, sha))
+
+  # heap of (-date, sha) of the commits waiting to be shown
+  heap = list()
+  seen = set()
+  for sha in shas:
+    if sha not in seen:
+      seen.add(sha)
+      heapq.heappush(heap, (-date(sha), sha))
+
+  while heap:
+    d, sha = heapq.heappop(heap)
+    d = -d
+
+    # everything left is older still
+    if since is not None and d < since:
+      return
+
+    for p in commit_parents(repo, sha):
+      if p not in seen:
+        seen.add(p)
+        heapq.heappush(heap, (-date(p), p))
+
+    if until is None or d <= until:
+      yield sha
+
+# print the graphviz nodes and edges of the given commits
+# parents left out by -n, --since or --until are drawn as dashed boundary nodes so no edge dangles
+def log_graphviz(repo, commits):
+  shown = set()
+  parents = list() # parents the edges point at, in the order they were met
+
+  for sha in commits:
+    shown.add(sha)
+    # get commit object
+    commit = object_read(repo, sha)
+
+    # check the format of the commit object for correctness
+    assert commit.fmt == b'commit'
+
+    message = commit_summary(commit)
+
+    # escape the backslashes and double quotes
+    message = message.replace("\\", "\\\\")
+    message = message.replace("\"", "\\\"")
+
+    # print the commit node with its short hash and message
+    print(" c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
+
+    # the edges to the parents, which come later in the walk
+    for p in commit_parents(repo, sha):
+      print("  c_{0} -> c_{1};".format(sha, p))
+      parents.append(p)
+
+  for p in dict.fromkeys(parents):
+    if p not in shown:
+      print(" c_{0} [label=\"{1}\", style=dashed]".format(p, p[0:7]))
+
+# parents of a commit, from the commit-graph when it has the commit
+def commit_parents(repo, sha):
+  graph = commit_graph(repo)
+  i = graph.index(sha) if graph else None
+  if i is not None:
+    return [ graph.sha_at(p) for p in graph.parents(i) ]
+
+  commit = object_read(repo, sha)
+
   # retrieve the parent commit
-  parents = commit.kvlm[b'parent']
+  parents = commit.kvlm.get(b'parent', [])
 
   # check if the parent is a list or not
   if type(parents) != list:
     parents = [ parents ]
 
-  # for each parent commit call the log_graphviz function
-  for p in parents:
-    p = p.decode("ascii")
-    print("  c_{0} -> c_{1};".format(sha, p))
-    log_graphviz(repo, p, seen)
+  return [ p.decode("ascii") for p in parents ]
 
-# Git tree leaf -> leaf contains the hash, mode and path
-class GitTreeLeaf(self, mode, path, sha):
-  def __init__(self, mode, path, sha):
-    self.mode = mode
+# parent value of a commit-graph entry with no parent
+GRAPH_PARENT_NONE = 0x70000000
+# flag marking the second parent as an index into the extra edges, and the last extra edge
+GRAPH_EXTRA_EDGES = 0x80000000
+# size of a commit data entry: tree, two parents, generation and date
+GRAPH_DATA_WIDTH = 20 + 4 + 4 + 8
+
+# commit-graph file in the git format, mapped into memory
+class GitCommitGraph(object):
+  """The objects/info/commit-graph file"""
+
+  def __init__(self, path):
     self.path = path
-    self.sha = sha
+
+    with open(path, "rb") as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # header: signature, version, hash version, number of chunks, number of base graphs
+    if self.data[0:4] != b'CGPH' or self.data[4] != 1 or self.data[5] != 1:
+      raise Exception("Unsupported commit-graph {0}".format(path))
+    count = self.data[6]
+
+    # the chunk table lists the id and offset of every chunk
+    chunks = dict()
+    for i in range(count):
+      start = 8 + 12 * i
+      chunks[self.data[start:start + 4]] = struct.unpack(">Q", self.data[start + 4:start + 12])[0]
+
+    for id in [ b'OIDF', b'OIDL', b'CDAT' ]:
+      if id not in chunks:
+        raise Exception("Malformed commit-graph {0}: missing {1} chunk".format(path, id.decode("ascii")))
+
+    self.fanout = struct.unpack(">256I", self.data[chunks[b'OIDF']:chunks[b'OIDF'] + 256 * 4])
+    self.count = self.fanout[255]
+    self.oids = chunks[b'OIDL']
+    self.commits = chunks[b'CDAT']
+    self.edges = chunks.get(b'EDGE')
+
+  # unmap the file
+  def close(self):
+    self.data.close()
+
+  # sha of the commit at position i
+  def sha_at(self, i):
+    start = self.oids + 20 * i
+    return self.data[start:start + 20].hex()
+
+  # position of a commit in the graph, or None if it is not in it
+  def index(self, sha):
+    key = bytes.fromhex(sha)
+    first = key[0]
+    lo = self.fanout[first - 1] if first else 0
+    hi = self.fanout[first]
+
+    while lo < hi:
+      mid = (lo + hi) // 2
+      start = self.oids + 20 * mid
+      cur = self.data[start:start + 20]
+      if cur < key:
+        lo = mid + 1
+      elif cur > key:
+        hi = mid
+      else:
+        return mid
+
+    return None
+
+  # sha of the root tree of the commit at position i
+  def tree(self, i):
+    start = self.commits + GRAPH_DATA_WIDTH * i
+    return self.data[start:start + 20].hex()
+
+  # positions of the parents of the commit at position i
+  def parents(self, i):
+    start = self.commits + GRAPH_DATA_WIDTH * i + 20
+    p1, p2 = struct.unpack(">II", self.data[start:start + 8])
+    ret = list()
+
+    if p1 != GRAPH_PARENT_NONE:
+      ret.append(p1)
+
+    if p2 == GRAPH_PARENT_NONE:
+      pass
+    elif p2 & GRAPH_EXTRA_EDGES:
+      # octopus merges list the remaining parents in the edge chunk, the last one is flagged
+      e = self.edges + 4 * (p2 & ~GRAPH_EXTRA_EDGES)
+      while True:
+        edge = struct.unpack(">I", self.data[e:e + 4])[0]
+        ret.append(edge & ~GRAPH_EXTRA_EDGES)
+        if edge & GRAPH_EXTRA_EDGES:
+          break
+        e += 4
+    else:
+      ret.append(p2)
+
+    return ret
+
+  # generation number and commit date of the commit at position i
+  def generation_date(self, i):
+    start = self.commits + GRAPH_DATA_WIDTH * i + 28
+    hi, lo = struct.unpack(">II", self.data[start:start + 8])
+    # the generation uses the top 30 bits, the date the low 2 bits and the next 32
+    return hi >> 2, ((hi & 3) << 32) | lo
+
+# the commit-graph of the repo if it has one, mapped once and reloaded when the file changes
+def commit_graph(repo):
+  path = repo_file(repo, "objects", "info", "commit-graph")
+  if not path or not os.path.isfile(path):
+    return None
+
+  mtime = os.stat(path).st_mtime_ns
+  if repo.graph is None or repo.graph_mtime != mtime:
+    if repo.graph:
+      repo.graph.close()
+    with trace_span("commit_graph_load"):
+      repo.graph = GitCommitGraph(path)
+    repo.graph_mtime = mtime
+
+  return repo.graph
+
+# commit time of a commit, the second to last field of the committer line
+def commit_date(commit):
+  return int(commit.kvlm[b'committer'].split(b' ')[-2])
+
+# write the commit-graph of every commit reachable from the refs
+@traced
+def commit_graph_write(repo):
+  import hashlib
+  # peel the tips down to commits, tags may point at anything
+  todo = list()
+  for sha in repo_tips(repo):
+    sha = object_find(repo, sha, fmt=b'commit')
+    if sha:
+      todo.append(sha)
+
+  # read every commit once: tree, parents and date
+  commits = dict()
+  while todo:
+    sha = todo.pop()
+    if sha in commits:
+      continue
+    commit = object_read(repo, sha)
+    parents = commit.kvlm.get(b'parent', [])
+    if type(parents) != list:
+      parents = [ parents ]
+    parents = [ p.decode("ascii") for p in parents ]
+    commits[sha] = (commit.kvlm[b'tree'].decode("ascii"), parents, commit_date(commit))
+    todo += parents
+
+  # generation numbers: 1 for roots, one more than the highest parent otherwise
+  generation = dict()
+  for sha in commits:
+    stack = [ sha ]
+    while stack:
+      cur = stack[-1]
+      if cur in generation:
+        stack.pop()
+        continue
+      pending = [ p for p in commits[cur][1] if p not in generation ]
+      if pending:
+        stack += pending
+      else:
+        generation[cur] = 1 + max([ generation[p] for p in commits[cur][1] ], default=0)
+        stack.pop()
+
+  order = sorted(commits)
+  index = { sha: i for i, sha in enumerate(order) }
+
+  fanout = bytearray()
+  counts = [0] * 256
+  for sha in order:
+    counts[int(sha[0:2], 16)] += 1
+  total = 0
+  for c in counts:
+    total += c
+    fanout += struct.pack(">I", total)
+
+  oids = bytearray()
+  data = bytearray()
+  edges = bytearray()
+  for sha in order:
+    tree, parents, date = commits[sha]
+    oids += bytes.fromhex(sha)
+
+    p = [ index[x] for x in parents ]
+    p1 = p[0] if p else GRAPH_PARENT_NONE
+    if len(p) < 2:
+      p2 = GRAPH_PARENT_NONE
+    elif len(p) == 2:
+      p2 = p[1]
+    else:
+      # octopus merge: point at the extra edges, flagging the last one
+      p2 = GRAPH_EXTRA_EDGES | (len(edges) // 4)
+      for x in p[1:-1]:
+        edges += struct.pack(">I", x)
+      edges += struct.pack(">I", GRAPH_EXTRA_EDGES | p[-1])
+
+    # dates are stored on 34 bits
+    date = min(max(date, 0), (1 << 34) - 1)
+    data += bytes.fromhex(tree) + struct.pack(">IIII", p1, p2, (generation[sha] << 2) | (date >> 32), date & 0xffffffff)
+
+  chunks = [ (b'OIDF', fanout), (b'OIDL', oids), (b'CDAT', data) ]
+  if edges:
+    chunks.append((b'EDGE', edges))
+
+  # header, then the table of chunk offsets closed by a zero id pointing at the end
+  out = bytearray(b'CGPH' + bytes([1, 1, len(chunks), 0]))
+  offset = len(out) + 12 * (len(chunks) + 1)
+  for id, chunk in chunks:
+    out += id + struct.pack(">Q", offset)
+    offset += len(chunk)
+  out += b'\x00' * 4 + struct.pack(">Q", offset)
+
+  for _, chunk in chunks:
+    out += chunk
+  out += hashlib.sha1(out).digest()
+
+  # write to a temporary file renamed over the old graph
+  path = repo_file(repo, "objects", "info", "commit-graph", mkdir=True)
+  tmp = path + ".lock"
+  with open(tmp, "wb") as f:
+    f.write(out)
+    repo_fsync_file(repo, "commit-graph", f)
+  os.rename(tmp, path)
+
+  return len(order)
+
+# commit-graph command
+@command("commit-graph", help="Write the commit-graph file.")
+def argsp_commit_graph(argsp):
+  argsp.add_argument("action",
+                     choices=["write"],
+                     help="What to do with the commit-graph")
+
+def cmd_commit_graph(args):
+  repo = repo_find()
+  count = commit_graph_write(repo)
+  print("Wrote commit-graph with {0} commits.".format(count))
+
+# Git tree leaf -> leaf contains the hash, mode and path
+# the path and hash are kept as stored in the tree, raw bytes, and only decoded when asked for
+class GitTreeLeaf(object):
+  __slots__ = ("mode", "raw_path", "oid")
+
+  def __init__(self, mode, raw_path, oid):
+    self.mode = mode          # mode as in the tree, 5 bytes for trees and 6 for the rest
+    self.raw_path = raw_path  # path as utf8 bytes
+    self.oid = oid            # binary 20 byte sha
+
+  # path decoded on demand
+  @property
+  def path(self):
+    return self.raw_path.decode("utf8")
+
+  @path.setter
+  def path(self, path):
+    self.raw_path = path.encode("utf8")
+
+  # hex sha decoded on demand
+  @property
+  def sha(self):
+    return self.oid.hex()
+
+  @sha.setter
+  def sha(self, sha):
+    self.oid = bytes.fromhex(sha)
 
 def tree_parse_one(raw, start=0):
   # find the space to get the mode
   x = raw.find(b' ',start)
   assert x-start == 5 or x-start == 6
 
-  # got the mode
-  mode = raw[start:x]
-  
-  # generalize to length 6 
-  if len(raw) == 5:
-    mode = b" " + mode
-
   # find the null byte to get the path
   y = raw.find(b'\x00', x)
 
-  path = raw[x+1:y]
+  # the mode, path and binary hash are sliced out as they are
+  return y+21, GitTreeLeaf(raw[start:x], raw[x+1:y], raw[y+1:y+21])
 
-  # get the hash
-  sha = format(int.from_bytes(raw[y+1:y+21], "big"), "040x")
-  return y+21, GitTreeLeaf(mode, path.decode("utf8"), sha)
-
-# wrapper for the parse which calls it in a loop
+# parse every entry of the tree, the loop of tree_parse_one inlined as this is hot for big trees
 def tree_parse(raw):
   pos = 0
   max = len(raw)
   ret = list()
+  find = raw.find
 
   while pos < max:
-    pos, data = tree_parse_one(raw, pos)
-    ret.append(data)
+    x = find(b' ', pos)
+    y = find(b'\x00', x)
+    ret.append(GitTreeLeaf(raw[pos:x], raw[x+1:y], raw[y+1:y+21]))
+    pos = y + 21
 
   return ret
 
@@ -552,24 +2474,20 @@ def tree_parse(raw):
 def tree_leaf_sort_key(leaf):
   # 10 is vale used to identify directories in unix based systems
   if leaf.mode.startswith(b"10"):
-    return leaf.path
+    return leaf.raw_path
   else:
-    return leaf.path + "/"
+    return leaf.raw_path + b"/"
   
 # function to serialize a tree object with leaves
 def tree_serialize(obj):
   obj.items.sort(key=tree_leaf_sort_key)
-  ret = b''
+  ret = list()
 
   # make the tuple containing the mode, path and sha
   for i in obj.items:
-    ret += i.mode
-    ret += b' '
-    ret += i.path.endcode("utf8")
-    sha = int(i.sha, 16)
-    ret += sha.to_bytes(20, byteorder="big")
+    ret.append(i.mode + b' ' + i.raw_path + b'\x00' + i.oid)
   
-  return ret
+  return b''.join(ret)
 
 # Git tree object    
 class GitTree(GitObject):
@@ -585,15 +2503,15 @@ class GitTree(GitObject):
     self.items = list()
 
 # ls-tree command
-argsp = argsubparsers.add_parser("ls-tree", help="Noice print a tree object.")
-
-argsp.add_argument("-r",
-                   dest="recursive",
-                   action="store_true",
-                   help="Recurse into sub-trees.")
+@command("ls-tree", help="Noice print a tree object.")
+def argsp_ls_tree(argsp):
+  argsp.add_argument("-r",
+                     dest="recursive",
+                     action="store_true",
+                     help="Recurse into sub-trees.")
 
-argsp.add_argument("tree",
-                   help="The tree object to show.")
+  argsp.add_argument("tree",
+                     help="The tree object to show.")
 
 # wrapper for the ls-tree command
 def cmd_ls_tree(args):
@@ -608,12 +2526,12 @@ def ls_tree(repo, ref, recursive=None, prefix=""):
   obj = object_read(repo, sha)
 
   # loop through the object list
-  for item in obj.mode:
-    # get the type of the object
-    if len(item) == 6:
-      type = item[0:2]
+  for item in obj.items:
+    # get the type of the object, trees have a 5 byte mode
+    if len(item.mode) == 6:
+      type = item.mode[0:2]
     else:
-      type = item[0:1]
+      type = b"0" + item.mode[0:1]
 
     # match the type
     match type:
@@ -633,26 +2551,161 @@ def ls_tree(repo, ref, recursive=None, prefix=""):
     else:
        ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
 
+# one difference between two trees, old or new is None for added and deleted paths
+class GitDiffEntry(object):
+  __slots__ = ("status", "raw_path", "old", "new")
+
+  def __init__(self, status, raw_path, old, new):
+    self.status = status      # "A", "D", "M" or "T"
+    self.raw_path = raw_path  # full path from the root of the trees, as utf8 bytes
+    self.old = old            # GitTreeLeaf in the old tree
+    self.new = new            # GitTreeLeaf in the new tree
+
+  @property
+  def path(self):
+    return self.raw_path.decode("utf8")
+
+# diff-tree command
+@command("diff-tree", help="Compare the content of two trees.")
+def argsp_diff_tree(argsp):
+  argsp.add_argument("-r",
+                     dest="recursive",
+                     action="store_true",
+                     help="Recurse into sub-trees.")
+
+  argsp.add_argument("--root",
+                     action="store_true",
+                     help="Show a root commit as adding all its files.")
+
+  argsp.add_argument("object",
+                     nargs="+",
+                     help="Two trees to compare or one commit to compare with its parent, then paths to limit the diff to.")
+
+def cmd_diff_tree(args):
+  repo = repo_find()
+
+  # like git the second name is a path unless it names an object
+  names = args.object
+  if len(names) > 1 and object_resolve(repo, names[1]):
+    old = object_find(repo, names[0], fmt=b'tree')
+    new = object_find(repo, names[1], fmt=b'tree')
+    paths = names[2:]
+  else:
+    commit = object_find(repo, names[0], fmt=b'commit')
+    if not commit:
+      raise Exception("diff-tree needs two trees or a commit: {0}".format(names[0]))
+    # like git nothing is shown for a merge, and for a root commit without --root
+    parents = commit_parents(repo, commit)
+    if len(parents) > 1 or not (parents or args.root):
+      return
+    old = object_find(repo, parents[0], fmt=b'tree') if parents else None
+    new = object_find(repo, commit, fmt=b'tree')
+    paths = names[1:]
+    print(commit)
+
+  for entry in diff_tree(repo, old, new, paths, args.recursive):
+    old_leaf, new_leaf = entry.old, entry.new
+    print(":{0} {1} {2} {3} {4}\t{5}".format(
+      diff_tree_mode(old_leaf),
+      diff_tree_mode(new_leaf),
+      old_leaf.sha if old_leaf else "0" * 40,
+      new_leaf.sha if new_leaf else "0" * 40,
+      entry.status,
+      entry.path))
+
+# mode of a leaf as git shows it, six digits and zeros for a missing leaf
+def diff_tree_mode(leaf):
+  if leaf is None:
+    return "000000"
+  return "0" * (6 - len(leaf.mode)) + leaf.mode.decode("ascii")
+
+# differences between the trees old and new as a generator of GitDiffEntry, in tree order
+# old or new is None for the empty tree, paths limits the diff to those paths and what is below them
+# subtrees with the same sha on both sides are skipped without being read, so the cost follows the size of the change
+def diff_tree(repo, old, new, paths=None, recursive=True):
+  specs = { p.strip("/").encode("utf8") for p in paths } if paths else None
+  if specs is not None and b'' in specs:
+    specs = None
+  return diff_tree_walk(repo, old, new, b'', specs, recursive)
+
+# merge the sorted entries of the two trees, prefix is the path of the trees with a trailing slash
+# specs is None when every path below prefix is wanted, else the wanted full paths below prefix
+def diff_tree_walk(repo, old, new, prefix, specs, recursive):
+  if trace:
+    trace.count("diff_tree_pairs")
+  a = object_read(repo, old).items if old else []
+  b = object_read(repo, new).items if new else []
+  i, j = 0, 0
+
+  while i < len(a) or j < len(b):
+    x = a[i] if i < len(a) else None
+    y = b[j] if j < len(b) else None
+
+    # trees sort as if their name ended with a slash, the order they are stored in
+    kx = (x.raw_path + b'/' if len(x.mode) == 5 else x.raw_path) if x else None
+    ky = (y.raw_path + b'/' if len(y.mode) == 5 else y.raw_path) if y else None
+
+    if y is None or (x is not None and kx < ky):
+      yield from diff_tree_entry(repo, prefix, specs, recursive, x, None)
+      i += 1
+    elif x is None or ky < kx:
+      yield from diff_tree_entry(repo, prefix, specs, recursive, None, y)
+      j += 1
+    else:
+      # the same sha and mode is the same content, whatever is below it
+      if x.oid != y.oid or x.mode != y.mode:
+        yield from diff_tree_entry(repo, prefix, specs, recursive, x, y)
+      i += 1
+      j += 1
+
+# the differences of one entry present in either tree or in both with the same kind
+def diff_tree_entry(repo, prefix, specs, recursive, x, y):
+  leaf = y or x
+  path = prefix + leaf.raw_path
+
+  if len(leaf.mode) == 5:
+    # a tree is entered when it is wanted or when a wanted path is below it
+    sub = None
+    if specs is not None and path not in specs:
+      below = path + b'/'
+      sub = { s for s in specs if s.startswith(below) }
+      if not sub:
+        return
+    if recursive:
+      yield from diff_tree_walk(repo, x.sha if x else None, y.sha if y else None, path + b'/', sub, recursive)
+      return
+  elif specs is not None and path not in specs:
+    return
+
+  # a file changing into a symlink or a submodule is a change of type, not of content
+  if x and y:
+    status = "M" if x.mode[:2] == y.mode[:2] else "T"
+  else:
+    status = "A" if y else "D"
+  yield GitDiffEntry(status, path, x, y)
+
 # checkout cmd
-argsp = argsubparsers.add_parser("checkout", help="checkout a commit inside of a directory.")
+@command("checkout", help="checkout a commit inside of a directory.")
+def argsp_checkout(argsp):
+  argsp.add_argument("commit",
+                     help="The commit or tree to checkout.")
 
-argsp.add_argument("commit",
-                   help="The commit or tree to checkout.")
+  argsp.add_argument("path",
+                     help="The EMPTY directory to checkout on.")
 
-argsp.add_argument("path",
-                   help="The EMPTY directory to checkout on.")
+  argsp.add_argument("-j",
+                     dest="jobs",
+                     type=int,
+                     default=None,
+                     help="Number of threads writing files")
 
 # wrapper for the checkout command
 def cmd_checkout(args):
   # find the repo
   repo = repo_find()
   
-  # get the object
-  obj = object_read(repo, object_find(repo, args.commit))
-
-  # if the object is a commit then get the tree object
-  if obj.fmt == b'commit':
-    obj = object_read(repo, obj.kvlm[b'tree'].decode("ascii"))
+  # get the tree object, following the commit or tag
+  obj = object_read(repo, object_find(repo, args.commit, fmt=b'tree'))
 
   # check if the path exists or not and there is an empty dir present
   if os.path.exists(args.path):
@@ -663,58 +2716,323 @@ def cmd_checkout(args):
   else:
     os.makedirs(args.path)
   
-  # call the ls tree function
-  ls_tree(repo, obj, os.path.realpath(args.path))
-
-def ls_tree(repo, tree, path):
-  for item in tree.items:
-    obj = object_read(repo, item.sha)
-    dest = os.path.join(path, item.path)
+  # write the tree into the directory
+  start = time.monotonic()
+  files, size = tree_checkout(repo, obj, os.path.realpath(args.path), jobs=args.jobs)
+  print("Checked out {0} files ({1} bytes) in {2:.2f}s.".format(files, size, time.monotonic() - start))
+
+# write a tree into an empty directory
+# the tree is walked first to create every directory, then the blobs are written by a pool of threads
+# returns the number of files and bytes written
+@traced
+def tree_checkout(repo, tree, path, jobs=None):
+  import concurrent.futures
+  blobs = list()
+  stack = [ (tree, path) ]
+
+  while stack:
+    tree, path = stack.pop()
+    for item in tree.items:
+      dest = os.path.join(path, item.path)
+
+      if item.mode == b'40000':
+        os.makedirs(dest)
+        stack.append((object_read(repo, item.sha), dest))
+      elif item.mode == b'160000':
+        # submodules are left as empty directories
+        os.makedirs(dest)
+      else:
+        blobs.append((item.sha, dest, item.mode))
+
+  # map the packs before the threads share them
+  pack_list(repo)
+
+  # inflating and writing release the gil, so threads overlap on cores and on the disk
+  progress = sys.stderr.isatty()
+  size = 0
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+    for i, n in enumerate(pool.map(lambda blob: blob_checkout(repo, *blob), blobs)):
+      size += n
+      if progress and (i % 1000 == 0 or i + 1 == len(blobs)):
+        sys.stderr.write("\rChecking out files: {0}% ({1}/{2})".format(100 * (i + 1) // len(blobs), i + 1, len(blobs)))
+  if progress and blobs:
+    sys.stderr.write("\n")
+
+  return len(blobs), size
+
+# write a single blob to dest, streamed, returns its size
+def blob_checkout(repo, sha, dest, mode):
+  _, size, data = object_read_stream(repo, sha)
+
+  # symlinks store their target as the blob
+  if mode == b'120000':
+    os.symlink(b''.join(data), dest)
+    return size
+
+  with open(dest, "wb") as f:
+    for chunk in data:
+      f.write(chunk)
+
+  if mode == b'100755':
+    os.chmod(dest, 0o755)
+
+  return size
+
+# table of every ref, loose ones read from refs/ over the packed ones
+class GitRefTable(object):
+  """Refs of a repository, loaded once and reloaded when packed-refs or a directory of refs/ changes"""
+
+  def __init__(self, repo):
+    self.refs = dict()    # full name -> sha, or "ref: <name>" for symbolic refs
+    self.peeled = dict()  # full name -> sha the annotated tag points at, from packed-refs
+    self.packed = dict()  # full name -> sha of the refs in packed-refs
+    self.traits = set()   # traits packed-refs claims in its header, like "fully-peeled"
+    self.loose = set()    # names of the refs with a file under refs/
+    self.dirs = list()    # directories under refs/, their mtime tells whether a loose ref was written
+
+    # the mtimes are taken before reading, a change made while loading makes the table stale
+    start = time.time_ns()
+    self.stamp = ref_table_stamp(repo, [])
+
+    # packed refs first, loose ones override them
+    path = repo_path(repo, "packed-refs")
+    if os.path.isfile(path):
+      self.packed, self.peeled, self.traits = packed_refs_read(path)
+      self.refs.update(self.packed)
+
+    stack = [ "refs" ]
+    while stack:
+      name = stack.pop()
+      path = repo_path(repo, name)
+      self.dirs.append(path)
+      self.stamp.append(path_mtime(path))
+      try:
+        entries = os.scandir(path)
+      except FileNotFoundError:
+        continue
+      with entries:
+        for e in entries:
+          if e.is_dir():
+            stack.append(name + "/" + e.name)
+          # lock files are refs being written
+          elif not e.name.endswith(".lock"):
+            if trace:
+              trace.count("ref_opens")
+            with open(e.path, "r") as f:
+              self.refs[name + "/" + e.name] = f.read().strip()
+            self.loose.add(name + "/" + e.name)
+            # a loose ref makes the peeled value of the packed one stale
+            self.peeled.pop(name + "/" + e.name, None)
+
+    self.racy_until = racy_until(start, self.stamp)
+
+# mtimes of packed-refs and of the given directories, any change means the table is stale
+def ref_table_stamp(repo, dirs):
+  return [ path_mtime(path) for path in [ repo_path(repo, "packed-refs") ] + dirs ]
+
+# mtime of a path in nanoseconds, None if it does not exist
+def path_mtime(path):
+  try:
+    return os.stat(path).st_mtime_ns
+  except FileNotFoundError:
+    return None
 
-    if obj.fmt == b'tree':
-      os.makedirs(dest)
-      ls_tree(repo, obj, path)
-    elif obj.fmt == b'blob':
-      with open(dest, "wb") as f:
-        f.write(obj.blobdata)
+# filesystems stamp mtimes from a clock lagging the wall clock, with a granularity as coarse as a second
+RACY_SLACK_NS = 10**9
+
+# racy git for caches: a change made in the same instant as the load can leave an mtime as it was
+# returns the time after which a cache loaded at start with these mtimes has to be loaded again, None if no mtime is that recent
+def racy_until(start, mtimes):
+  racy = [ m for m in mtimes if m is not None and m >= start - RACY_SLACK_NS ]
+  return max(racy) + RACY_SLACK_NS if racy else None
+
+# the ref table of the repo, reloaded when it is stale
+# a table loaded right after a ref changed is loaded once more later, so a long lived repository never keeps missing a change
+def ref_table(repo):
+  table = repo.refs
+  if table is None or ref_table_stamp(repo, table.dirs) != table.stamp \
+     or (table.racy_until is not None and time.time_ns() > table.racy_until):
+    with trace_span("ref_table_load"):
+      table = repo.refs = GitRefTable(repo)
+  return table
+
+# parse packed-refs into name -> sha and name -> peeled sha
+def packed_refs_read(path):
+  if trace:
+    trace.count("ref_opens")
+
+  refs = dict()
+  peeled = dict()
+  traits = set()
+  last = None
+
+  with open(path, "r") as f:
+    for line in f:
+      line = line.rstrip("\n")
+      # the header lists the traits of the file
+      if line.startswith("# pack-refs with:"):
+        traits.update(line[len("# pack-refs with:"):].split())
+        continue
+      if not line or line.startswith("#"):
+        continue
+      # the object an annotated tag peels to, after the tag
+      if line.startswith("^"):
+        if last:
+          peeled[last] = line[1:]
+        continue
+      sha, _, last = line.partition(" ")
+      refs[last] = sha
+
+  return refs, peeled, traits
+
+# write packed-refs through a lock file
+# fully_peeled claims that every ref without a peeled line is known not to be an annotated tag
+def packed_refs_write(repo, refs, peeled, fully_peeled=True):
+  path = repo_file(repo, "packed-refs")
+  with GitLockFile(path, "w") as f:
+    f.write("# pack-refs with: peeled {0}sorted \n".format("fully-peeled " if fully_peeled else ""))
+    # git sorts the refs by their bytes
+    for name in sorted(refs, key=lambda n: n.encode("utf8")):
+      f.write("{0} {1}\n".format(refs[name], name))
+      if name in peeled:
+        f.write("^{0}\n".format(peeled[name]))
+    repo_fsync_file(repo, "reference", f)
+  repo.refs = None
 
 # resolve the ref
 def ref_resolve(repo, ref):
-  path = repo_path(repo, ref) # get the path
+  # refs under refs/ come from the table, others like HEAD are files in the gitdir
+  if ref.startswith("refs/"):
+    data = ref_table(repo).refs.get(ref)
+  else:
+    path = repo_path(repo, ref) # get the path
 
-  # there may be no commit yet and hence no ref
-  if not os.path.isfile(path):
-    return None
+    # there may be no commit yet and hence no ref
+    if not os.path.isfile(path):
+      return None
 
-  with open(path, 'r') as fp:
-    data = fp.read()[:-1] # remove the newline
-  
+    if trace:
+      trace.count("ref_opens")
+    with open(path, 'r') as fp:
+      data = fp.read()[:-1] # remove the newline
+
+  if data is None:
+    return None
   if data.startswith("ref: "):
     return ref_resolve(repo, data[5:])
   else:
     return data
 
 # the references are stored in sorted order by git
-def ref_list(repo, path=None):
-  if not path:
-    path = repo_dir(repo, "refs")
+def ref_list(repo):
   ret = collections.OrderedDict() #dict to store the references
 
-  for f in sorted(os.listdir(path)):
-    can = os.path.join(path, f)
-    if os.psth.isdir(can):
-      ret[f] = ref_list(repo, can)
-    else:
-      ref[f] = ref_resolve(repo, can)
+  # nest the refs by the components of their names, under refs/
+  table = ref_table(repo)
+  for name in sorted(table.refs, key=lambda n: n.encode("utf8")):
+    parts = name.split("/")[1:]
+    node = ret
+    for part in parts[:-1]:
+      node = node.setdefault(part, collections.OrderedDict())
+    # only symbolic refs need resolving, the table checked for staleness once is enough for the others
+    value = table.refs[name]
+    node[parts[-1]] = ref_resolve(repo, value[5:]) if value.startswith("ref: ") else value
 
   return ret
 
-argsp = argsubparsers.add_parser("show-ref", help="List references.")
+# pack-refs command
+@command("pack-refs", help="Pack refs into packed-refs.")
+def argsp_pack_refs(argsp):
+  argsp.add_argument("--all",
+                     action="store_true",
+                     help="Pack every ref, not only the tags and the refs already packed.")
+
+  argsp.add_argument("--no-prune",
+                     dest="prune",
+                     action="store_false",
+                     help="Keep the loose refs that were packed.")
+
+def cmd_pack_refs(args):
+  repo = repo_find()
+  count = pack_refs(repo, pack_all=args.all, prune=args.prune)
+  print("Packed {0} refs.".format(count))
+
+# move loose refs into packed-refs, returns the number of refs packed
+def pack_refs(repo, pack_all=False, prune=True):
+  table = ref_table(repo)
+  refs = dict(table.packed)
+  peeled = { k: v for k, v in table.peeled.items() if k in refs }
+  # the refs kept from packed-refs are only known to be fully peeled if it said so
+  fully_peeled = not refs or "fully-peeled" in table.traits
+
+  loose = dict()
+  for name in table.loose:
+    value = table.refs[name]
+    # symbolic refs stay loose, and branches unless asked for, they move too often
+    if value.startswith("ref: "):
+      continue
+    if not (pack_all or name.startswith("refs/tags/") or name in table.packed):
+      continue
+    loose[name] = value
+    refs[name] = value
+    peeled.pop(name, None)
+
+    # annotated tags get the object they point at recorded, so peeling needs no object read
+    sha = value
+    header = object_read_header(repo, sha)
+    while header and header[0] == b'tag':
+      sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
+      header = object_read_header(repo, sha)
+    # a ref to a missing object cannot be peeled, it is packed without a peeled line and the file is not fully peeled
+    if not header:
+      fully_peeled = False
+    elif sha != value:
+      peeled[name] = sha
+
+  packed_refs_write(repo, refs, peeled, fully_peeled)
+
+  if prune:
+    for name, value in loose.items():
+      ref_prune(repo, name, value)
+    repo.refs = None
+
+  return len(loose)
+
+# delete a loose ref that was packed, unless it changed meanwhile, and the directories left empty
+def ref_prune(repo, name, value):
+  path = repo_path(repo, name)
+
+  # under the lock of the ref so an update cannot land between the check and the unlink, a ref being written stays
+  lock = GitLockFile(path, "w", required=False)
+  with lock as f:
+    if f is None:
+      return
+    lock.cancel()
+    try:
+      with open(path, "r") as ref:
+        if ref.read().strip() != value:
+          return
+      os.unlink(path)
+    except FileNotFoundError:
+      return
+
+  # the top directories of refs/ stay
+  parts = name.split("/")[:-1]
+  while len(parts) > 2:
+    try:
+      os.rmdir(repo_path(repo, *parts))
+    except OSError:
+      break
+    parts.pop()
+
+@command("show-ref", help="List references.")
+def argsp_show_ref(argsp):
+  pass
 
 def cmd_show_ref(args):
   repo = repo_find()
   refs = ref_list(repo)
-  show_ref(repo, refs,with_hash=true, prefix="")
+  show_ref(repo, refs, with_hash=True, prefix="refs")
 
 def show_ref(repo, refs, with_hash=True, prefix=""):  
   for k, v in refs.items():
@@ -731,43 +3049,44 @@ class GitTag(GitCommit):
   fmt = b'tag'
 
 # add the tag command
-argsp = argsubparsers.add_parser("tag", help="List and create tags")
-
-argsp.add_argument("-a",
-                    action="store_true",
-                    dest="tag_object",
-                    help="Whether to create a tag object")
-              
-argsp.add_argument("name",
-                    help="The name of the tag")
-                
-argsp.add_argument("object",
-                    default="HEAD",
-                    nargs="?",
-                    help="The object the tag refers to")
+@command("tag", help="List and create tags")
+def argsp_tag(argsp):
+  argsp.add_argument("-a",
+                      action="store_true",
+                      dest="tag_object",
+                      help="Whether to create a tag object")
+
+  argsp.add_argument("name",
+                      nargs="?",
+                      help="The name of the tag")
+
+  argsp.add_argument("object",
+                      default="HEAD",
+                      nargs="?",
+                      help="The object the tag refers to")
 
 def cmd_tag(args):
   repo = repo_find()
 
   if args.name:
-    tag_create(repo, args.name, args.object, type='object' if args.create_tag_object else "ref")
+    tag_create(repo, args.name, args.object, create_tag_object=args.tag_object)
   else:
     refs = ref_list(repo)
-    show_ref(repo, refs["tags"], with_hash=False)
+    show_ref(repo, refs.get("tags", {}), with_hash=False)
   
 def tag_create(repo, name, ref, create_tag_object=False):
 
   sha = object_find(repo, ref)
 
   if create_tag_object:
-    tag = GitTag(repo)
+    tag = GitTag()
     tag.kvlm = collections.OrderedDict()
     tag.kvlm[b'object'] = sha.encode()
     tag.kvlm[b'type'] = b'commit'
     tag.kvlm[b'tag'] = name.encode()
     tag.kvlm[b'tagger'] = b'Wyag<wyag@example.com>'
     tag.kvlm[None] = b"A tag generated by Wyag, which wont let you customize its message."
-    tag_sha = object_write(tag,)
+    tag_sha = object_write(tag, repo)
     ref_create(repo, "tags/" + name, tag_sha)
 
   else:
@@ -775,9 +3094,97 @@ def tag_create(repo, name, ref, create_tag_object=False):
 
 # write the reference to the repo
 def ref_create(repo, ref, sha):
-  path = repo_file(repo, "refs/" + ref_name) 
-  with open(path, 'w') as fp:
+  path = repo_file(repo, "refs", *ref.split("/"), mkdir=True)
+  # through a lock file so readers never see half a ref, and the directory mtime tells the ref table
+  with GitLockFile(path, "w") as fp:
     fp.write(sha + "\n")
+    repo_fsync_file(repo, "reference", fp)
+
+# sorted object ids of the repository for resolving abbreviated shas
+# the pack indexes are sorted tables already, the loose objects are listed one fanout directory at a time
+class GitOidIndex(object):
+  """Sorted object ids stored loose and in packs"""
+
+  def __init__(self, repo):
+    self.repo = repo
+    self.loose = dict() # fanout directory -> (mtime, sorted list of binary shas, racy_until of the listing)
+
+  # sorted binary shas of the loose objects in the fanout directory of the first byte
+  # a listing taken right after the directory changed is taken again later, an object written in the same instant keeps its mtime
+  def loose_dir(self, first):
+    name = "{0:02x}".format(first)
+    path = repo_path(self.repo, "objects", name)
+    start = time.time_ns()
+    mtime = path_mtime(path)
+
+    entry = self.loose.get(first)
+    if entry is None or entry[0] != mtime or (entry[2] is not None and start > entry[2]):
+      shas = list()
+      if mtime is not None:
+        for f in os.listdir(path):
+          # temporary files of writes in progress are not objects
+          if len(f) == 38:
+            try:
+              shas.append(bytes.fromhex(name + f))
+            except ValueError:
+              pass
+      entry = self.loose[first] = (mtime, sorted(shas), racy_until(start, [ mtime ]))
+
+    return entry[1]
+
+  # sorted hex shas starting with the given hex prefix, at least 2 characters long
+  def prefix(self, prefix):
+    key = bytes.fromhex(prefix if len(prefix) % 2 == 0 else prefix + "0")
+    ret = set()
+
+    shas = self.loose_dir(key[0])
+    i = bisect.bisect_left(shas, key)
+    while i < len(shas) and shas[i].hex().startswith(prefix):
+      ret.add(shas[i].hex())
+      i += 1
+
+    for pack in pack_list(self.repo):
+      ret.update(pack.prefix(prefix))
+
+    return sorted(ret)
+
+  # length of the longest hex prefix the sha shares with another object
+  def common(self, sha):
+    key = bytes.fromhex(sha)
+    ret = 0
+
+    # in every sorted table only the neighbours of the sha can share a longer prefix than the rest
+    shas = self.loose_dir(key[0])
+    i = bisect.bisect_left(shas, key)
+    for j in (i - 1, i + 1 if i < len(shas) and shas[i] == key else i):
+      if 0 <= j < len(shas):
+        ret = max(ret, oid_common_prefix(key, shas[j]))
+
+    for pack in pack_list(self.repo):
+      i = pack.search(key)
+      for j in (i - 1, i + 1 if i < pack.count and pack.sha_at(i) == key else i):
+        if 0 <= j < pack.count:
+          ret = max(ret, oid_common_prefix(key, pack.sha_at(j)))
+
+    return ret
+
+# the oid index of the repo
+def oid_index(repo):
+  if repo.oids is None:
+    repo.oids = GitOidIndex(repo)
+  return repo.oids
+
+# number of leading hex digits two binary shas have in common
+def oid_common_prefix(a, b):
+  for i in range(len(a)):
+    if a[i] != b[i]:
+      # the high nibble still matches when the difference is in the low one
+      return 2 * i + (1 if (a[i] ^ b[i]) < 16 else 0)
+  return 2 * len(a)
+
+# shortest unique abbreviation of a sha, at least length digits long
+def object_abbrev(repo, sha, length=7):
+  return sha[:max(length, oid_index(repo).common(sha) + 1)]
 
 def object_resolve(repo, name):
 
@@ -791,26 +3198,19 @@ def object_resolve(repo, name):
 
   # check if it is a head
   if name == "HEAD":
-    return [ ref_resolve(repo, "HEAD") ]
+    head = ref_resolve(repo, "HEAD")
+    # an empty repo has no commit behind HEAD yet
+    return [ head ] if head else []
 
-  # if it is a hex string check for a hash
+  # if it is a hex string check for a hash, loose or packed
   if hashRE.match(name):
-      name = name.lower()
-      prefix = name[0:2]
-      path = repo_dir(repo, "objects", prefix, mkdir=False)
-      if path:
-          rem = name[2:]
-          for f in os.listdir(path):
-            if f.startswith(rem):
-              candidates.append(prefix + f)
-
-  as_tag = ref_resolve(repo, "refs/tags/" + name)
-  if as_tag: 
-      candidates.append(as_tag)
-
-  as_branch = ref_resolve(repo, "refs/heads/" + name)
-  if as_branch: 
-    candidates.append(as_branch)
+    candidates += oid_index(repo).prefix(name.lower())
+
+  # tags and branches, the ref table is checked for staleness once for both
+  refs = ref_table(repo).refs
+  for ref in ("refs/tags/" + name, "refs/heads/" + name):
+    if ref in refs:
+      candidates.append(ref_resolve(repo, ref))
 
   return candidates
 
@@ -831,34 +3231,46 @@ def object_find(repo, name, fmt=None, follow=True):
   if not fmt:
     return sha
 
-  # read the object and check the format by accessing the kvlm
+  # check the format from the commit-graph or the object header, only tags and commits that must be followed are read
+  graph = commit_graph(repo)
   while True:
-    obj = object_read(repo, sha)
+    i = graph.index(sha) if graph else None
+    if i is not None:
+      obj_fmt = b'commit'
+    else:
+      obj_fmt, _ = object_read_header(repo, sha)
 
-    if obj.fmt == fmt:
+    if obj_fmt == fmt:
       return sha
 
     if not follow:
       return None
 
           # Follow tags
-    if obj.fmt == b'tag':
-      sha = obj.kvlm[b'object'].decode("ascii")
-    elif obj.fmt == b'commit' and fmt == b'tree':
-      sha = obj.kvlm[b'tree'].decode("ascii")
+    if obj_fmt == b'tag':
+      sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
+    elif obj_fmt == b'commit' and fmt == b'tree':
+      sha = graph.tree(i) if i is not None else object_read(repo, sha).kvlm[b'tree'].decode("ascii")
     else:
       return None
 
-argsp = argsubparsers.add_parser("rev-parse", help="Parse revision (or other objects) identifiers")
+@command("rev-parse", help="Parse revision (or other objects) identifiers")
+def argsp_rev_parse(argsp):
+  argsp.add_argument("--wyag-type",
+                     metavar="type",
+                     dest="type",
+                     choices=["blob", "commit", "tag", "tree"],
+                     default=None,
+                     help="Specify the expected type")
 
-argsp.add_argument("--wyag-type",
-                   metavar="type",
-                   dest="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   default=None,
-                   help="Specify the expected type")
+  argsp.add_argument("--short",
+                     metavar="length",
+                     nargs="?",
+                     const="",
+                     default=None,
+                     help="Print the shortest unique abbreviation, at least length (core.abbrev, 7) digits long")
 
-argsp.add_argument("name", help="The name to parse")
+  argsp.add_argument("name", nargs="*", help="The names to parse")
 
 def cmd_rev_parse(args):
   if args.type:
@@ -866,12 +3278,167 @@ def cmd_rev_parse(args):
   else:
     fmt = None
 
+  # like git the length has to be given as --short=length, "--short HEAD" abbreviates HEAD
+  if args.short and not args.short.isdigit():
+    args.name.insert(0, args.short)
+    args.short = ""
+  if not args.name:
+    raise Exception("rev-parse needs a name to parse")
+
   repo = repo_find()
 
-  print (object_find(repo, args.name, fmt, follow=True))
+  # git never abbreviates to less than 4 digits
+  if args.short is not None:
+    length = max(4, int(args.short or repo.conf.getint("core", "abbrev", fallback=7)))
+
+  for name in args.name:
+    sha = object_find(repo, name, fmt, follow=True)
+    print(object_abbrev(repo, sha, length) if sha and args.short is not None else sha)
+
+# list every object reachable from the given shas as (sha, fmt, name, size)
+# name is the last path component the object was found under, used to sort delta candidates
+@traced
+def object_walk(repo, shas):
+  seen = set()
+  ret = list()
+  stack = [ (sha, "") for sha in shas ]
+
+  while stack:
+    sha, name = stack.pop()
+    if sha in seen:
+      continue
+    seen.add(sha)
+
+    raw = object_read_raw(repo, sha)
+    if raw is None:
+      raise Exception("Missing object {0}".format(sha))
+    fmt, data = raw
+    ret.append((sha, fmt, name, len(data)))
+
+    match fmt:
+      case b'commit':
+        commit = GitCommit(data)
+        stack.append((commit.kvlm[b'tree'].decode("ascii"), ""))
+        parents = commit.kvlm.get(b'parent', [])
+        if type(parents) != list:
+          parents = [ parents ]
+        for p in parents:
+          stack.append((p.decode("ascii"), ""))
+      case b'tag':
+        stack.append((GitTag(data).kvlm[b'object'].decode("ascii"), ""))
+      case b'tree':
+        for item in GitTree(data).items:
+          # submodule commits live in another repository
+          if not item.mode.startswith(b'16'):
+            stack.append((item.sha, item.path))
+
+  return ret
+
+# flatten the nested dict of ref_list into a list of shas
+def ref_list_shas(refs):
+  ret = list()
+  for v in refs.values():
+    if type(v) == str:
+      ret.append(v)
+    elif v:
+      ret += ref_list_shas(v)
+  return ret
+
+# shas of every ref and of HEAD, which may be detached
+def repo_tips(repo):
+  shas = ref_list_shas(ref_list(repo))
+  head = ref_resolve(repo, "HEAD")
+  if head:
+    shas.append(head)
+  return shas
+
+# repack command
+@command("repack", help="Pack reachable objects into a single pack.")
+def argsp_repack(argsp):
+  argsp.add_argument("-d",
+                     dest="prune",
+                     action="store_true",
+                     help="Remove the loose objects and packs made redundant by the new pack.")
+
+  argsp.add_argument("--window",
+                     type=int,
+                     default=10,
+                     help="Number of objects considered as delta bases.")
+
+  argsp.add_argument("--depth",
+                     type=int,
+                     default=50,
+                     help="Maximum delta chain length.")
+
+# gc command, a repack that always prunes
+@command("gc", help="Pack reachable objects and prune the redundant ones.")
+def argsp_gc(argsp):
+  pass
+
+def cmd_repack(args):
+  repo = repo_find()
+  repack(repo, prune=args.prune, window=args.window, depth=args.depth)
+
+def cmd_gc(args):
+  repo = repo_find()
+  repack(repo, prune=True)
+
+# pack every reachable object and optionally remove what the new pack makes redundant
+@traced
+def repack(repo, prune=False, window=10, depth=50):
+  start = time.monotonic()
+
+  objects = object_walk(repo, repo_tips(repo))
+  if not objects:
+    print("Nothing to pack.")
+    return
+
+  old_packs = list(pack_list(repo))
+  path, deltas = pack_write(repo, objects, window=window, depth=depth)
+  after = os.path.getsize(path) + os.path.getsize(path[:-len(".pack")] + ".idx")
+  before = 0
+
+  if prune:
+    packed = set(sha for sha, _, _, _ in objects)
+
+    # the loose copies of packed objects
+    for sha in packed:
+      loose = repo_file(repo, "objects", sha[0:2], sha[2:])
+      if loose and os.path.isfile(loose):
+        before += os.path.getsize(loose)
+        os.remove(loose)
+        try:
+          os.rmdir(os.path.dirname(loose))
+        except OSError:
+          pass # the fanout directory still holds other objects
+
+    # old packs whose objects all made it into the new pack
+    for pack in old_packs:
+      # repacking an already packed repo can produce the very same pack
+      if pack.path == path:
+        before += after
+        continue
+      if os.path.exists(pack.path[:-len(".pack")] + ".keep"):
+        continue
+      if all(pack.sha_at(i).hex() in packed for i in range(pack.count)):
+        before += os.path.getsize(pack.path) + os.path.getsize(pack.idx_path)
+        pack.close()
+        repo.packs.remove(pack)
+        os.remove(pack.path)
+        os.remove(pack.idx_path)
+
+  print("Packed {0} objects ({1} deltas) into {2} in {3:.2f}s.".format(
+    len(objects), deltas, os.path.basename(path), time.monotonic() - start))
+  if prune:
+    print("Removed {0} bytes, pack is {1} bytes, saved {2} bytes.".format(before, after, before - after))
+  else:
+    print("Pack is {0} bytes.".format(after))
 
 class GitIndexEntry(object):
-  def __init__(self, ctime=None, mtime=None, dev=None, ino=None, mode_type=None, uid=None, gid=None, fsize=None, sha=None, flag_assume_valid=None, flag_stage=None, name=None):
+  __slots__ = ("ctime", "mtime", "dev", "ino", "mode", "uid", "gid", "size", "sha",
+               "flag_assume_valid", "flag_stage", "flags_extended", "name")
+
+  def __init__(self, ctime=None, mtime=None, dev=None, ino=None, mode=None, uid=None, gid=None, fsize=None, sha=None, flag_assume_valid=False, flag_stage=0, flags_extended=0, name=None):
     self.ctime = ctime # creation time in seconds and nanoseconds
     self.mtime = mtime  # modification time in seconds and nanoseconds
     self.dev = dev # device number
@@ -883,6 +3450,1381 @@ class GitIndexEntry(object):
     self.sha = sha  # hash
     self.flag_assume_valid = flag_assume_valid # assume file is valid 
     self.flag_stage = flag_stage  # stage of the file
+    self.flags_extended = flags_extended # version 3 flags: skip worktree and intent to add
     self.name = name  # name of the file
 
+# fixed part of an index entry: ctime, mtime, dev, ino, mode, uid, gid, size, sha and flags
+INDEX_ENTRY_STAT = struct.Struct(">LLLLLLLLLL20sH")
+
+# bits of the flags field of an index entry
+INDEX_FLAG_ASSUME_VALID = 0x8000
+INDEX_FLAG_EXTENDED     = 0x4000
+INDEX_FLAG_STAGE_SHIFT  = 12
+INDEX_NAME_MASK         = 0x0fff
+
+# bits of the version 3 extended flags
+INDEX_EXTENDED_SKIP_WORKTREE = 0x4000
+INDEX_EXTENDED_INTENT_TO_ADD = 0x2000
+
+# the index as a compact table: one packed stat record per entry in a single bytearray
+# next to the sorted list of names, GitIndexEntry objects are only built when asked for
+class GitIndex(object):
+  """The .git/index file"""
+
+  def __init__(self, version=2):
+    self.version = version
+    self.stats = bytearray()       # INDEX_ENTRY_STAT.size bytes per entry
+    self.names = list()            # entry names as bytes, sorted, in the same order
+    self.flags_extended = array.array("H") # version 3 extended flags per entry
+    self.extensions = list()       # (signature, data) of the extensions, kept as they are
+    self.stamp = None              # index_stamp of the file it was read from
+
+  def __len__(self):
+    return len(self.names)
+
+  # an independent copy, the entries are modified in place
+  def copy(self):
+    ret = GitIndex(self.version)
+    ret.stats = bytearray(self.stats)
+    ret.names = list(self.names)
+    ret.flags_extended = array.array("H", self.flags_extended)
+    ret.extensions = list(self.extensions)
+    ret.stamp = self.stamp
+    return ret
+
+  # position of the entry with this name and stage, or None
+  def find(self, name, stage=0):
+    name = name.encode("utf8") if type(name) == str else name
+    i = bisect.bisect_left(self.names, name)
+
+    while i < len(self.names) and self.names[i] == name:
+      if self.stage(i) == stage:
+        return i
+      i += 1
+
+    return None
+
+  # stage of the entry at position i
+  def stage(self, i):
+    flags = struct.unpack_from(">H", self.stats, (i + 1) * INDEX_ENTRY_STAT.size - 2)[0]
+    return (flags >> INDEX_FLAG_STAGE_SHIFT) & 3
+
+  # hex sha of the entry at position i
+  def sha(self, i):
+    start = i * INDEX_ENTRY_STAT.size + 40
+    return self.stats[start:start + 20].hex()
+
+  # decode the entry at position i
+  def entry(self, i):
+    (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, uid, gid, size, sha, flags) = INDEX_ENTRY_STAT.unpack_from(self.stats, i * INDEX_ENTRY_STAT.size)
+
+    return GitIndexEntry(ctime=(ctime_s, ctime_ns),
+                         mtime=(mtime_s, mtime_ns),
+                         dev=dev,
+                         ino=ino,
+                         mode=mode,
+                         uid=uid,
+                         gid=gid,
+                         fsize=size,
+                         sha=sha.hex(),
+                         flag_assume_valid=bool(flags & INDEX_FLAG_ASSUME_VALID),
+                         flag_stage=(flags >> INDEX_FLAG_STAGE_SHIFT) & 3,
+                         flags_extended=self.flags_extended[i],
+                         name=self.names[i].decode("utf8"))
+
+  # decode every entry in order
+  def entries(self):
+    for i in range(len(self.names)):
+      yield self.entry(i)
+
+  # add an entry, replacing the one with the same name and stage
+  def add(self, entry):
+    name = entry.name.encode("utf8")
+
+    # the stat fields are 32 bits on disk, bigger values are truncated like git does
+    flags = min(len(name), INDEX_NAME_MASK) | (entry.flag_stage << INDEX_FLAG_STAGE_SHIFT)
+    if entry.flag_assume_valid:
+      flags |= INDEX_FLAG_ASSUME_VALID
+    if entry.flags_extended:
+      flags |= INDEX_FLAG_EXTENDED
+
+    record = INDEX_ENTRY_STAT.pack(entry.ctime[0] & 0xffffffff, entry.ctime[1],
+                                   entry.mtime[0] & 0xffffffff, entry.mtime[1],
+                                   entry.dev & 0xffffffff, entry.ino & 0xffffffff, entry.mode,
+                                   entry.uid & 0xffffffff, entry.gid & 0xffffffff, entry.size & 0xffffffff,
+                                   bytes.fromhex(entry.sha), flags)
+
+    # entries are sorted by name then stage
+    i = bisect.bisect_left(self.names, name)
+    while i < len(self.names) and self.names[i] == name and self.stage(i) < entry.flag_stage:
+      i += 1
+
+    width = INDEX_ENTRY_STAT.size
+    if i < len(self.names) and self.names[i] == name and self.stage(i) == entry.flag_stage:
+      self.stats[i * width:(i + 1) * width] = record
+      self.flags_extended[i] = entry.flags_extended
+    else:
+      self.stats[i * width:i * width] = record
+      self.names.insert(i, name)
+      self.flags_extended.insert(i, entry.flags_extended)
+
+    self.invalidate()
+
+  # remove every stage of the entry with this name, returns whether there was one
+  def remove(self, name):
+    name = name.encode("utf8") if type(name) == str else name
+    i = bisect.bisect_left(self.names, name)
+    j = i
+    while j < len(self.names) and self.names[j] == name:
+      j += 1
+
+    if i == j:
+      return False
+
+    del self.stats[i * INDEX_ENTRY_STAT.size:j * INDEX_ENTRY_STAT.size]
+    del self.names[i:j]
+    del self.flags_extended[i:j]
+    self.invalidate()
+    return True
+
+  # store fresh stat data for the entry at position i, keeping its sha and flags
+  def set_stat(self, i, st):
+    width = INDEX_ENTRY_STAT.size
+    record = INDEX_ENTRY_STAT.unpack_from(self.stats, i * width)
+    self.stats[i * width:(i + 1) * width] = INDEX_ENTRY_STAT.pack(
+      (st.st_ctime_ns // 10**9) & 0xffffffff, st.st_ctime_ns % 10**9,
+      (st.st_mtime_ns // 10**9) & 0xffffffff, st.st_mtime_ns % 10**9,
+      st.st_dev & 0xffffffff, st.st_ino & 0xffffffff, record[6],
+      st.st_uid & 0xffffffff, st.st_gid & 0xffffffff, st.st_size & 0xffffffff,
+      record[10], record[11])
+
+  # zero the size of the entry at position i so its stat data never matches and it gets rehashed
+  def smudge(self, i):
+    struct.pack_into(">L", self.stats, i * INDEX_ENTRY_STAT.size + 36, 0)
+
+  # the cached tree extension describes the old entries, drop it when they change
+  def invalidate(self):
+    self.extensions = [ (sig, data) for sig, data in self.extensions if sig != b'TREE' ]
+
+# read the index of the repo, an empty one if the repo has none yet
+@traced
+def index_read(repo):
+  index_file = repo_file(repo, "index")
+  if not index_file or not os.path.exists(index_file) or os.path.getsize(index_file) == 0:
+    return GitIndex()
+
+  # the parsed index is kept until the file changes, callers get a copy they are free to modify
+  stamp = index_stamp(index_file)
+  if repo.index and repo.index[0] == stamp:
+    return repo.index[1].copy()
+
+  with open(index_file, "rb") as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  try:
+    index = index_parse(data)
+  finally:
+    data.close()
+
+  index.stamp = stamp
+  repo.index = (stamp, index)
+  return index.copy()
+
+# stat data telling whether the index file changed, None when there is none
+def index_stamp(path):
+  try:
+    st = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino)
+
+# parse the raw index
+def index_parse(data):
+  import hashlib
+  if data[0:4] != b'DIRC':
+    raise Exception("Not an index file")
+
+  # the file ends with the sha1 of everything before it, all zeros when git was told to skip it (index.skipHash)
+  checksum = data[-20:]
+  if checksum != b'\x00' * 20:
+    view = memoryview(data)
+    try:
+      with view[:-20] as content:
+        if hashlib.sha1(content).digest() != checksum:
+          raise Exception("Bad index file sha1 signature")
+    finally:
+      view.release()
+
+  version, count = struct.unpack(">II", data[4:12])
+  if version not in (2, 3):
+    raise Exception("Unsupported index version {0}".format(version))
+
+  index = GitIndex(version)
+  width = INDEX_ENTRY_STAT.size
+  stats = list()
+  names = list()
+  flags_extended = array.array("H")
+
+  # the last 20 bytes are the checksum of the file
+  end = len(data) - 20
+  pos = 12
+
+  for _ in range(count):
+    start = pos
+    stats.append(data[pos:pos + width])
+    flags = struct.unpack(">H", data[pos + width - 2:pos + width])[0]
+    pos += width
+
+    # version 3 entries may carry 2 more bytes of flags
+    if flags & INDEX_FLAG_EXTENDED:
+      flags_extended.append(struct.unpack(">H", data[pos:pos + 2])[0])
+      pos += 2
+    else:
+      flags_extended.append(0)
+
+    # the length of the name is in the flags unless it does not fit in 12 bits
+    size = flags & INDEX_NAME_MASK
+    if size == INDEX_NAME_MASK:
+      size = data.find(b'\x00', pos) - pos
+    names.append(data[pos:pos + size])
+    pos += size
+
+    # entries are padded with 1 to 8 null bytes to a multiple of 8
+    pos = start + ((pos - start + 8) & ~7)
+
+  # the extensions follow the entries: 4 bytes signature, 4 bytes size, data
+  extensions = list()
+  while pos + 8 <= end:
+    sig = data[pos:pos + 4]
+    size = struct.unpack(">I", data[pos + 4:pos + 8])[0]
+    extensions.append((sig, data[pos + 8:pos + 8 + size]))
+    pos += 8 + size
+
+  index.stats = bytearray(b''.join(stats))
+  index.names = names
+  index.flags_extended = flags_extended
+  index.extensions = extensions
+  return index
+
+# write the index, through a lock file renamed into place
+# a refresh only saves stat data, it is skipped rather than failing when another process holds the lock
+# or replaced the file since the index was read, so it never overwrites a concurrent change
+# returns whether the index was written
+@traced
+def index_write(repo, index, refresh=False):
+  import hashlib
+  width = INDEX_ENTRY_STAT.size
+  extended = any(index.flags_extended)
+
+  # version 3 is only needed for the extended flags
+  version = 3 if extended else 2
+  out = [ b'DIRC' + struct.pack(">II", version, len(index)) ]
+
+  path = repo_file(repo, "index")
+  lock = GitLockFile(path, required=not refresh)
+  with lock as f:
+    if f is None:
+      return False
+    if refresh and index_stamp(path) != index.stamp:
+      lock.cancel()
+      return False
+
+    # the lock file is created first, the index is at least as new as it
+    index_smudge_racy(index, os.fstat(f.fileno()).st_mtime_ns)
+
+    for i, name in enumerate(index.names):
+      entry = [ index.stats[i * width:(i + 1) * width] ]
+      if index.flags_extended[i]:
+        entry.append(struct.pack(">H", index.flags_extended[i]))
+      entry.append(name)
+
+      # pad with 1 to 8 null bytes to a multiple of 8
+      size = sum(len(e) for e in entry)
+      entry.append(b'\x00' * (8 - size % 8))
+      out.append(b''.join(entry))
+
+    for sig, data in index.extensions:
+      out.append(sig + struct.pack(">I", len(data)) + data)
+
+    data = b''.join(out)
+    f.write(data)
+    f.write(hashlib.sha1(data).digest())
+    repo_fsync_file(repo, "index", f)
+
+  return True
+
+# racy git: a file changed again in the instant the index is written keeps the stat data of the entry
+# zero the size of the entries modified at or after the index so they are hashed instead of passing for clean
+def index_smudge_racy(index, index_mtime):
+  width = INDEX_ENTRY_STAT.size
+  for i in range(len(index)):
+    mtime_s, mtime_ns = struct.unpack_from(">LL", index.stats, i * width + 8)
+    mode = struct.unpack_from(">L", index.stats, i * width + 24)[0]
+    if mode != 0o160000 and mtime_s * 10**9 + mtime_ns >= index_mtime:
+      index.smudge(i)
+
+# ls-files command
+@command("ls-files", help="List all the staged files.")
+def argsp_ls_files(argsp):
+  argsp.add_argument("-s", "--stage",
+                     dest="stage",
+                     action="store_true",
+                     help="Show the mode, sha and stage of each entry.")
+
+def cmd_ls_files(args):
+  repo = repo_find()
+  index = index_read(repo)
+
+  for e in index.entries():
+    if args.stage:
+      print("{0:06o} {1} {2}\t{3}".format(e.mode, e.sha, e.flag_stage, e.name))
+    else:
+      print(e.name)
+
+# rm command
+@command("rm", help="Remove files from the working tree and the index.")
+def argsp_rm(argsp):
+  argsp.add_argument("--cached",
+                     action="store_true",
+                     help="Only remove the files from the index.")
+
+  argsp.add_argument("path", nargs="+", help="Files to remove")
+
+def cmd_rm(args):
+  repo = repo_find()
+  rm(repo, args.path, delete=not args.cached)
+
+# name of a worktree path in the index: relative to the worktree, with forward slashes
+# only the directory is resolved, a symlink is tracked under its own name and not its target's
+def index_name(repo, path):
+  worktree = os.path.realpath(repo.worktree)
+  path = os.path.abspath(path)
+  path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+
+  if os.path.commonpath([worktree, path]) != worktree or path == worktree:
+    raise Exception("Cannot handle paths outside of worktree: {0}".format(path))
+
+  return os.path.relpath(path, worktree).replace(os.sep, "/")
+
+# remove paths from the index and optionally from the worktree
+def rm(repo, paths, delete=True, skip_missing=False):
+  index = index_read(repo)
+
+  for path in paths:
+    name = index_name(repo, path)
+    if not index.remove(name) and not skip_missing:
+      raise Exception("Cannot remove paths not in the index: {0}".format(path))
+    if delete and os.path.lexists(path):
+      os.unlink(path)
+
+  index_write(repo, index)
+
+# add command
+@command("add", help="Add files contents to the index.")
+def argsp_add(argsp):
+  argsp.add_argument("path", nargs="+", help="Files to add")
+
+def cmd_add(args):
+  repo = repo_find()
+  add(repo, args.path)
+
+# index entry for a file of the worktree, from its stat data and its sha
+def index_entry_from_stat(name, st, sha):
+  # only regular files, executables and symlinks are tracked
+  if stat.S_ISLNK(st.st_mode):
+    mode = 0o120000
+  elif st.st_mode & 0o100:
+    mode = 0o100755
+  else:
+    mode = 0o100644
+
+  return GitIndexEntry(ctime=(st.st_ctime_ns // 10**9, st.st_ctime_ns % 10**9),
+                       mtime=(st.st_mtime_ns // 10**9, st.st_mtime_ns % 10**9),
+                       dev=st.st_dev,
+                       ino=st.st_ino,
+                       mode=mode,
+                       uid=st.st_uid,
+                       gid=st.st_gid,
+                       fsize=st.st_size,
+                       sha=sha,
+                       name=name)
+
+# hash files into the repo and stage them, directories are added recursively
+def add(repo, paths):
+  index = index_read(repo)
+  index_file = repo_file(repo, "index")
+  index_mtime = os.stat(index_file).st_mtime_ns if os.path.exists(index_file) else None
+  filemode = repo.conf.getboolean("core", "filemode", fallback=True)
+
+  # tracked files the filesystem monitor did not see change are not even looked at
+  monitor = fsmonitor_changed(repo, index)
+  candidates = set(index.names[i] for i in monitor[1]) if monitor and monitor[1] is not None else None
+  added = set()
+
+  files = list()
+  for path in paths:
+    if os.path.isdir(path) and not os.path.islink(path):
+      for root, dirs, names in os.walk(path):
+        if ".git" in dirs:
+          dirs.remove(".git")
+        files += [ os.path.join(root, n) for n in names ]
+    else:
+      files.append(path)
+
+  # the objects are synced together and in place before the index refers to them
+  with repo.write_batch():
+    for path in files:
+      name = index_name(repo, path)
+      i = index.find(name)
+      if i is not None and candidates is not None and name.encode("utf8") not in candidates:
+        continue
+
+      # files whose stat data matches the index do not need hashing again
+      st = os.lstat(path)
+      added.add(name)
+      if i is not None and index_stat_compare(index, i, st, index_mtime, filemode) == "clean":
+        continue
+
+      # symlinks store their target
+      if stat.S_ISLNK(st.st_mode):
+        sha = object_write(GitBlob(os.readlink(path).encode("utf8")), repo)
+      else:
+        with open(path, "rb") as fd:
+          sha = object_hash(fd, b'blob', repo)
+
+      entry = index_entry_from_stat(name, st, sha)
+      # without core.filemode the executable bit on disk means nothing, a tracked file keeps its mode
+      if not filemode and i is not None and stat.S_ISREG(st.st_mode) and index.entry(i).mode in (0o100644, 0o100755):
+        entry.mode = index.entry(i).mode
+      index.add(entry)
+
+  index_write(repo, index)
+
+  # what the monitor reported and we did not add still has to be checked by status
+  if candidates is not None:
+    fsmonitor_state_write(repo, monitor[0], sorted(n.decode("utf8") for n in candidates if n.decode("utf8") not in added))
+
+# parse one line of a gitignore file into (pattern, ignore, dir_only, anchored), None for blanks and comments
+def gitignore_parse1(raw):
+  raw = raw.rstrip("\r\n").rstrip(" ")
+
+  if not raw or raw[0] == "#":
+    return None
+
+  # a leading ! re-includes what earlier rules excluded, a backslash escapes ! and #
+  ignore = True
+  if raw[0] == "!":
+    ignore = False
+    raw = raw[1:]
+  elif raw[0] == "\\":
+    raw = raw[1:]
+
+  # a trailing slash only matches directories
+  dir_only = raw.endswith("/")
+  raw = raw.rstrip("/")
+
+  # a slash anywhere else anchors the pattern to the directory of the gitignore file
+  anchored = "/" in raw
+  raw = raw.lstrip("/")
+
+  if not raw:
+    return None
+  return (raw, ignore, dir_only, anchored)
+
+# parse the lines of a gitignore file
+def gitignore_parse(lines):
+  ret = list()
+  for line in lines:
+    rule = gitignore_parse1(line)
+    if rule:
+      ret.append(rule)
+  return ret
+
+# the ignore rules of a worktree
+class GitIgnore(object):
+  absolute = None # rules from info/exclude and the global excludes file
+  scoped = None   # directory relative to the worktree -> rules of its .gitignore, None if it has none
+
+  def __init__(self, absolute, scoped):
+    self.absolute = absolute
+    self.scoped = scoped
+
+# read the rules that do not depend on a directory, the .gitignore files are read when first needed
+def gitignore_read(repo):
+  absolute = list()
+
+  # the global excludes file, then the one of the repo
+  paths = list()
+  excludes = repo.conf.get("core", "excludesfile", fallback=None)
+  if excludes:
+    paths.append(os.path.expanduser(excludes))
+  else:
+    config_home = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
+    paths.append(os.path.join(config_home, "git", "ignore"))
+  paths.append(repo_path(repo, "info", "exclude"))
+
+  for path in paths:
+    if os.path.isfile(path):
+      with open(path, "r") as f:
+        absolute += gitignore_parse(f.readlines())
+
+  return GitIgnore(absolute, dict())
+
+# rules of the .gitignore in a directory of the worktree, read once
+def gitignore_scope(repo, ignore, dir):
+  if dir not in ignore.scoped:
+    path = os.path.join(repo.worktree, dir, ".gitignore")
+    rules = None
+    if os.path.isfile(path):
+      with open(path, "r") as f:
+        rules = gitignore_parse(f.readlines())
+    ignore.scoped[dir] = rules
+
+  return ignore.scoped[dir]
+
+# match a path relative to the directory of the rules, None if no rule matches, the last match wins
+def check_ignore1(rules, path, is_dir):
+  from fnmatch import fnmatch
+  result = None
+  base = path.rsplit("/", 1)[-1]
+
+  for pattern, ignore, dir_only, anchored in rules:
+    if dir_only and not is_dir:
+      continue
+    if fnmatch(path if anchored else base, pattern):
+      result = ignore
+
+  return result
+
+# match a path against every rule that applies to it, deeper .gitignore files taking precedence
+# the parent directories are assumed not to be ignored
+def gitignore_match(repo, ignore, path, is_dir):
+  result = check_ignore1(ignore.absolute, path, is_dir)
+
+  parts = path.split("/")
+  for i in range(len(parts)):
+    rules = gitignore_scope(repo, ignore, "/".join(parts[:i]))
+    if rules:
+      r = check_ignore1(rules, "/".join(parts[i:]), is_dir)
+      if r is not None:
+        result = r
+
+  return bool(result)
+
+# check if a path relative to the worktree is ignored
+def check_ignore(repo, ignore, path, is_dir=False):
+  parts = path.split("/")
+
+  # nothing inside an ignored directory can be re-included
+  for i in range(1, len(parts)):
+    if gitignore_match(repo, ignore, "/".join(parts[:i]), True):
+      return True
+
+  return gitignore_match(repo, ignore, path, is_dir)
+
+# check-ignore command
+@command("check-ignore", help="Check path(s) against ignore rules.")
+def argsp_check_ignore(argsp):
+  argsp.add_argument("path", nargs="+", help="Paths to check")
+
+def cmd_check_ignore(args):
+  repo = repo_find()
+  ignore = gitignore_read(repo)
+
+  for path in args.path:
+    if check_ignore(repo, ignore, index_name(repo, path), os.path.isdir(path)):
+      print(path)
+
+# status command
+@command("status", help="Show the working tree status.")
+def argsp_status(argsp):
+  argsp.add_argument("-j",
+                     dest="jobs",
+                     type=int,
+                     default=None,
+                     help="Number of threads checking the worktree")
+
+def cmd_status(args):
+  repo = repo_find()
+  index = index_read(repo)
+
+  status_branch(repo)
+  status_head_index(repo, index)
+  print()
+  status_index_worktree(repo, index, jobs=args.jobs)
+
+# name of the checked out branch, None if HEAD is detached
+def branch_get_active(repo):
+  with open(repo_file(repo, "HEAD"), "r") as f:
+    head = f.read()
+
+  if head.startswith("ref: refs/heads/"):
+    return head[16:-1]
+  return None
+
+def status_branch(repo):
+  branch = branch_get_active(repo)
+  if branch:
+    print("On branch {0}.".format(branch))
+  else:
+    print("HEAD detached at {0}".format(object_find(repo, "HEAD")))
+
+# flatten a tree into a dict of path -> sha of its blobs
+def tree_to_dict(repo, ref):
+  ret = dict()
+  stack = [ (object_find(repo, ref, fmt=b'tree'), "") ]
+
+  while stack:
+    sha, prefix = stack.pop()
+    for leaf in object_read(repo, sha).items:
+      path = prefix + leaf.path
+      if leaf.mode == b'40000':
+        stack.append((leaf.sha, path + "/"))
+      else:
+        ret[path] = leaf.sha
+
+  return ret
+
+# changes between the HEAD commit and the index
+@traced
+def status_head_index(repo, index):
+  print("Changes to be committed:")
+
+  head = tree_to_dict(repo, "HEAD") if object_resolve(repo, "HEAD") else dict()
+  for i, name in enumerate(index.names):
+    name = name.decode("utf8")
+    if name in head:
+      if head.pop(name) != index.sha(i):
+        print("  modified:", name)
+    else:
+      print("  added:   ", name)
+
+  # whatever is left was deleted from the index
+  for name in head:
+    print("  deleted: ", name)
+
+# entries checked by one task of the status thread pool
+STATUS_BATCH = 512
+
+# compare the entry at position i with the lstat of its file
+# returns "clean", "modified" when the stat data proves it, or "check" when only the content can tell
+def index_stat_compare(index, i, st, index_mtime, filemode=True):
+  (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, uid, gid, size, sha, flags) = INDEX_ENTRY_STAT.unpack_from(index.stats, i * INDEX_ENTRY_STAT.size)
+
+  # entries git was told not to look at
+  if flags & INDEX_FLAG_ASSUME_VALID or index.flags_extended[i] & INDEX_EXTENDED_SKIP_WORKTREE:
+    return "clean"
+
+  # submodules are directories, their content is another repository
+  if mode == 0o160000:
+    return "clean" if stat.S_ISDIR(st.st_mode) else "modified"
+
+  # a different kind of file, or a different size, is a change whatever the content
+  if stat.S_ISLNK(st.st_mode) != (mode == 0o120000) or not (stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+    return "modified"
+  if filemode and stat.S_ISREG(st.st_mode) and bool(st.st_mode & 0o100) != (mode == 0o100755):
+    return "modified"
+  # a size of zero is an entry smudged as racy, only its content can tell
+  if st.st_size & 0xffffffff != size:
+    return "modified" if size else "check"
+
+  if ((st.st_mtime_ns // 10**9) & 0xffffffff, st.st_mtime_ns % 10**9) != (mtime_s, mtime_ns) \
+     or ((st.st_ctime_ns // 10**9) & 0xffffffff, st.st_ctime_ns % 10**9) != (ctime_s, ctime_ns) \
+     or st.st_ino & 0xffffffff != ino or st.st_uid & 0xffffffff != uid or st.st_gid & 0xffffffff != gid:
+    return "check"
+
+  # racy clean: a file changed in the same instant the index was written has the stat data of the old content
+  if index_mtime is not None and mtime_s * 10**9 + mtime_ns >= index_mtime:
+    return "check"
+
+  return "clean"
+
+# hash a worktree file like add would store it
+def worktree_hash(path, st):
+  if stat.S_ISLNK(st.st_mode):
+    return object_write(GitBlob(os.readlink(path).encode("utf8")))
+  with open(path, "rb") as fd:
+    return object_hash(fd, b'blob')
+
+# compare every index entry with the worktree, returns a list of (name, "modified" or "deleted")
+# files are only hashed when their stat data differs from the index or is racy,
+# entries found clean after hashing get their stat data refreshed in the index
+@traced
+def index_worktree_changes(repo, index, jobs=None):
+  import concurrent.futures
+  index_file = repo_file(repo, "index")
+  index_mtime = os.stat(index_file).st_mtime_ns if index_file and os.path.exists(index_file) else None
+  filemode = repo.conf.getboolean("core", "filemode", fallback=True)
+
+  # with a filesystem monitor running only the paths it reports and the ones dirty last time are looked at
+  monitor = fsmonitor_changed(repo, index)
+  positions = monitor[1] if monitor and monitor[1] is not None else range(len(index))
+
+  # lstat and compare a batch of entries, lstat releases the gil so the batches overlap
+  def compare(batch):
+    ret = list()
+    for i in batch:
+      path = os.path.join(repo.worktree, index.names[i].decode("utf8"))
+      try:
+        st = os.lstat(path)
+      except (FileNotFoundError, NotADirectoryError):
+        ret.append((i, "deleted", None))
+        continue
+      ret.append((i, index_stat_compare(index, i, st, index_mtime, filemode), st))
+    return ret
+
+  # hash the files whose stat data could not decide
+  def rehash(item):
+    i, _, st = item
+    path = os.path.join(repo.worktree, index.names[i].decode("utf8"))
+    try:
+      return worktree_hash(path, st) == index.sha(i)
+    except FileNotFoundError:
+      return False
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+    results = list()
+    batches = [ positions[k:k + STATUS_BATCH] for k in range(0, len(positions), STATUS_BATCH) ]
+    for batch in pool.map(compare, batches):
+      results += batch
+
+    check = [ r for r in results if r[1] == "check" ]
+    same = list(pool.map(rehash, check))
+
+  changes = [ (i, state) for i, state, _ in results if state == "modified" or state == "deleted" ]
+
+  dirty = False
+  for (i, _, st), clean in zip(check, same):
+    if clean:
+      index.set_stat(i, st)
+      dirty = True
+    else:
+      changes.append((i, "modified"))
+      # the stat data may still match the new content, make sure it never passes for clean
+      if index_stat_compare(index, i, st, None, filemode) == "clean":
+        index.smudge(i)
+        dirty = True
+
+  # save the refreshed stat data so the next run does not hash these files again
+  if dirty:
+    index_write(repo, index, refresh=True)
+
+  changes = [ (index.names[i].decode("utf8"), state) for i, state in sorted(changes) ]
+
+  # the changed entries have to be checked again next time even if the monitor does not report them
+  if monitor:
+    fsmonitor_state_write(repo, monitor[0], [ name for name, _ in changes ])
+
+  return changes
+
+# version of the untracked cache file format
+UNTRACKED_CACHE_VERSION = 1
+
+# stat data of a file that tells if it changed, None if it does not exist
+def file_signature(path):
+  try:
+    st = os.stat(path)
+  except (FileNotFoundError, NotADirectoryError):
+    return None
+  return [ st.st_mtime_ns, st.st_size, st.st_ino ]
+
+# signature of the ignore rules that apply everywhere, the cache is dropped when they change
+def gitignore_signature(repo):
+  excludes = repo.conf.get("core", "excludesfile", fallback=None)
+  config_home = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
+  path = os.path.expanduser(excludes) if excludes else os.path.join(config_home, "git", "ignore")
+
+  return [ path, file_signature(path), file_signature(repo_path(repo, "info", "exclude")) ]
+
+# read the untracked cache, None if there is none or if it was built with other global rules
+def untracked_cache_read(repo, rules):
+  import json
+  path = repo_file(repo, "untracked-cache")
+  if not path or not os.path.isfile(path):
+    return None
+
+  try:
+    with open(path, "r") as f:
+      cache = json.load(f)
+  except ValueError:
+    return None
+
+  if cache.get("version") != UNTRACKED_CACHE_VERSION or cache.get("rules") != rules:
+    return None
+  return cache
+
+# write the untracked cache, through a lock file renamed into place
+def untracked_cache_write(repo, rules, written, dirs):
+  import json
+  path = repo_file(repo, "untracked-cache")
+  with open(path + ".lock", "w") as f:
+    json.dump({ "version": UNTRACKED_CACHE_VERSION, "rules": rules, "written": written, "dirs": dirs }, f)
+  os.rename(path + ".lock", path)
+
+# list a directory of the worktree, returns the cache record [mtime, .gitignore signature, files, subdirectories]
+# ignored entries are left out, so they are never matched again while the directory is unchanged
+def untracked_scan(repo, ignore, rel, mtime, gitignore):
+  prefix = rel + "/" if rel else ""
+  files = list()
+  dirs = list()
+
+  with os.scandir(os.path.join(repo.worktree, rel)) as entries:
+    for e in entries:
+      is_dir = e.is_dir(follow_symlinks=False)
+      if is_dir and e.name == ".git":
+        continue
+      if gitignore_match(repo, ignore, prefix + e.name, is_dir):
+        continue
+      (dirs if is_dir else files).append(e.name)
+
+  return [ mtime, gitignore, sorted(files), sorted(dirs) ]
+
+# untracked files of the worktree, skipping ignored directories
+# directories whose mtime and .gitignore did not change since the last run are taken from the untracked cache
+# instead of being listed and matched against the ignore rules again
+@traced
+def worktree_untracked(repo, index, ignore):
+  use_cache = repo.conf.getboolean("core", "untrackedcache", fallback=True)
+  rules = gitignore_signature(repo)
+  cache = untracked_cache_read(repo, rules) if use_cache else None
+
+  old = cache["dirs"] if cache else dict()
+  written = cache["written"] if cache else 0
+  start = time.time_ns()
+
+  dirs = dict()
+  ret = list()
+  stack = [ ("", False) ]
+
+  while stack:
+    rel, dirty = stack.pop()
+    mtime = os.lstat(os.path.join(repo.worktree, rel)).st_mtime_ns
+    gitignore = file_signature(os.path.join(repo.worktree, rel, ".gitignore"))
+    record = old.get(rel)
+
+    # a new .gitignore changes what is ignored in every directory below
+    child_dirty = dirty or (record is not None and record[1] != gitignore)
+
+    # a directory changed in the instant the cache was written may have changed again unnoticed
+    if dirty or record is None or record[0] != mtime or record[1] != gitignore or mtime >= written:
+      record = untracked_scan(repo, ignore, rel, mtime, gitignore)
+    dirs[rel] = record
+
+    prefix = rel + "/" if rel else ""
+    for f in record[2]:
+      if not index_has(index, prefix + f):
+        ret.append(prefix + f)
+    for d in record[3]:
+      stack.append((prefix + d, child_dirty))
+
+  if use_cache and dirs != old:
+    untracked_cache_write(repo, rules, start, dirs)
+
+  return sorted(ret)
+
+# check if the index has an entry with this name, in any stage
+def index_has(index, name):
+  name = name.encode("utf8")
+  i = bisect.bisect_left(index.names, name)
+  return i < len(index.names) and index.names[i] == name
+
+# changes between the index and the worktree, then the untracked files
+def status_index_worktree(repo, index, jobs=None):
+  print("Changes not staged for commit:")
+
+  for name, state in index_worktree_changes(repo, index, jobs=jobs):
+    print("  {0:<9} {1}".format(state + ":", name))
+
+  print()
+  print("Untracked files:")
+
+  for name in worktree_untracked(repo, index, gitignore_read(repo)):
+    print(" ", name)
+
+# flags of inotify, from <sys/inotify.h>
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_DONT_FOLLOW  = 0x02000000
+IN_ISDIR        = 0x40000000
+
+# events watched on every directory of the worktree
+FSMONITOR_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+               | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+# struct inotify_event without its name: wd, mask, cookie, length of the name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# seconds a client waits for the daemon before falling back to a full scan
+FSMONITOR_TIMEOUT = 5
+
+# daemon watching the worktree with inotify, it answers with the paths changed since a token
+# a token is "<daemon id>:<sequence number>", tokens of another daemon or from before an overflow get a full scan
+class GitFsMonitor(object):
+  """Filesystem monitor of a worktree"""
+
+  def __init__(self, repo):
+    import ctypes
+    import ctypes.util
+    self.repo = repo
+    self.id = os.urandom(8).hex() # tokens of a previous daemon are never valid
+    self.seq = 0          # sequence number of the last change
+    self.overflow = 0     # sequence number of the last lost event
+    self.broken = False   # set when a directory could not be watched, every query gets a full scan
+    self.changes = dict() # path -> sequence number of its last change
+    self.wds = dict()     # watch descriptor -> directory relative to the worktree
+    self.quit = False
+
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    self.watch("")
+
+  # watch a directory and every directory below it
+  # with mark set their content is reported as changed, it may have been created before the watch
+  def watch(self, rel, mark=False):
+    import ctypes
+    import errno
+    stack = [ rel ]
+
+    while stack:
+      rel = stack.pop()
+      path = os.path.join(self.repo.worktree, rel)
+
+      wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), FSMONITOR_MASK)
+      if wd < 0:
+        err = ctypes.get_errno()
+        if err not in (errno.ENOENT, errno.ENOTDIR):
+          # out of watches: changes in this directory would go unseen
+          self.broken = True
+        continue
+      self.wds[wd] = rel
+
+      try:
+        with os.scandir(path) as entries:
+          for e in entries:
+            name = rel + "/" + e.name if rel else e.name
+            if mark:
+              self.changed(name)
+            if e.is_dir(follow_symlinks=False) and e.name != ".git":
+              stack.append(name)
+      except (FileNotFoundError, NotADirectoryError):
+        pass
+
+  # record a change
+  def changed(self, path):
+    self.seq += 1
+    self.changes[path] = self.seq
+
+  # events were lost, nothing before now can be trusted
+  def overflowed(self):
+    self.seq += 1
+    self.overflow = self.seq
+    self.changes.clear()
+
+  # read every pending event
+  def drain(self):
+    while True:
+      try:
+        data = os.read(self.fd, 64 * 1024)
+      except BlockingIOError:
+        return
+
+      pos = 0
+      while pos < len(data):
+        wd, mask, _, size = INOTIFY_EVENT.unpack_from(data, pos)
+        name = os.fsdecode(data[pos + INOTIFY_EVENT.size:pos + INOTIFY_EVENT.size + size].rstrip(b'\x00'))
+        pos += INOTIFY_EVENT.size + size
+
+        if mask & IN_Q_OVERFLOW:
+          self.overflowed()
+          continue
+
+        rel = self.wds.get(wd)
+        if rel is None:
+          continue
+        if mask & IN_IGNORED:
+          del self.wds[wd]
+          continue
+
+        path = rel + "/" + name if rel and name else name or rel
+        if path == ".git" or path.startswith(".git/"):
+          continue
+        self.changed(path)
+
+        # new directories are watched too
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+          self.watch(path, mark=True)
+
+  # paths changed since a token
+  def query(self, token):
+    # events queued before the query are part of the answer
+    self.drain()
+
+    full = True
+    paths = list()
+    if token and not self.broken:
+      id, _, seq = token.partition(":")
+      if id == self.id and seq.isdigit() and int(seq) >= self.overflow:
+        full = False
+        paths = [ p for p, s in self.changes.items() if s > int(seq) ]
+
+    return { "token": "{0}:{1}".format(self.id, self.seq), "full": full, "paths": paths }
+
+  # serve queries on the socket until told to quit
+  def serve(self, path):
+    import select
+    import socket
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+
+    try:
+      while not self.quit:
+        ready = select.select([ self.fd, server ], [], [])[0]
+        if self.fd in ready:
+          self.drain()
+        if server in ready:
+          conn, _ = server.accept()
+          with conn:
+            conn.settimeout(FSMONITOR_TIMEOUT)
+            try:
+              self.handle(conn)
+            except (OSError, ValueError):
+              pass # a client that went away or sent garbage
+    finally:
+      server.close()
+      os.unlink(path)
+      os.close(self.fd)
+
+  # answer one request: a json object on one line
+  def handle(self, conn):
+    import json
+    request = json.loads(socket_read_line(conn))
+
+    match request.get("command"):
+      case "query" : reply = self.query(request.get("token"))
+      case "quit"  :
+        self.quit = True
+        reply = { "ok": True }
+      case _       : reply = { "error": "unknown command" }
+
+    conn.sendall(json.dumps(reply).encode("utf8") + b'\n')
+
+# read a line from a socket
+def socket_read_line(conn):
+  data = b''
+  while not data.endswith(b'\n'):
+    chunk = conn.recv(64 * 1024)
+    if not chunk:
+      break
+    data += chunk
+  return data.decode("utf8")
+
+# send a request to the fsmonitor daemon of the repo, None if there is no daemon answering
+def fsmonitor_request(repo, request):
+  import json
+  import socket
+  path = repo_path(repo, "fsmonitor.sock")
+  if not os.path.exists(path):
+    return None
+
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+      conn.settimeout(FSMONITOR_TIMEOUT)
+      conn.connect(path)
+      conn.sendall(json.dumps(request).encode("utf8") + b'\n')
+      return json.loads(socket_read_line(conn))
+  except (OSError, ValueError):
+    return None
+
+# checksum at the end of the index file, the monitor state is only valid for the index it was saved with
+def index_checksum(repo):
+  path = repo_file(repo, "index")
+  if not path or not os.path.exists(path):
+    return None
+
+  with open(path, "rb") as f:
+    f.seek(-20, os.SEEK_END)
+    return f.read(20).hex()
+
+# save the token of the last query and the names that were dirty then
+def fsmonitor_state_write(repo, token, dirty):
+  import json
+  path = repo_file(repo, "fsmonitor-state")
+  with open(path + ".lock", "w") as f:
+    json.dump({ "token": token, "index": index_checksum(repo), "dirty": dirty }, f)
+  os.rename(path + ".lock", path)
+
+# the saved monitor state, None if there is none or if the index was written by someone else since
+def fsmonitor_state_read(repo):
+  import json
+  path = repo_file(repo, "fsmonitor-state")
+  if not path or not os.path.isfile(path):
+    return None
+
+  try:
+    with open(path, "r") as f:
+      state = json.load(f)
+  except ValueError:
+    return None
+
+  if state.get("index") != index_checksum(repo):
+    return None
+  return state
+
+# positions of the entries named by a path: the entry itself and everything below it if it is a directory
+def index_prefix_positions(index, name):
+  key = name.encode("utf8")
+
+  lo = bisect.bisect_left(index.names, key)
+  hi = lo
+  while hi < len(index.names) and index.names[hi] == key:
+    hi += 1
+
+  # "0" is the byte after "/", the range holds every name starting with "<name>/"
+  below = bisect.bisect_left(index.names, key + b"/")
+  end = bisect.bisect_left(index.names, key + b"0")
+
+  return list(range(lo, hi)) + list(range(below, end))
+
+# ask the monitor what changed since the last run
+# returns None without a monitor, (token, None) when everything has to be checked,
+# or (token, sorted positions of the index entries to check)
+@traced
+def fsmonitor_changed(repo, index):
+  if repo.conf.get("core", "fsmonitor", fallback="true").lower() in ("false", "no", "off", "0"):
+    return None
+
+  state = fsmonitor_state_read(repo)
+  reply = fsmonitor_request(repo, { "command": "query", "token": state["token"] if state else None })
+  if not reply or "token" not in reply:
+    return None
+  if reply["full"] or state is None:
+    return reply["token"], None
+
+  positions = set()
+  for path in reply["paths"] + state["dirty"]:
+    positions.update(index_prefix_positions(index, path))
+
+  return reply["token"], sorted(positions)
+
+# fsmonitor command
+@command("fsmonitor", help="Run a daemon watching the worktree for status.")
+def argsp_fsmonitor(argsp):
+  argsp.add_argument("action",
+                     choices=["run", "start", "stop", "status"],
+                     help="run in the foreground, start in the background, stop or check the daemon")
+
+def cmd_fsmonitor(args):
+  repo = repo_find()
+
+  match args.action:
+    case "run"    : fsmonitor_run(repo)
+    case "start"  : fsmonitor_start(repo)
+    case "stop"   :
+      if fsmonitor_request(repo, { "command": "quit" }) is None:
+        print("No fsmonitor running.")
+    case "status" :
+      reply = fsmonitor_request(repo, { "command": "query" })
+      print("fsmonitor running, token {0}.".format(reply["token"]) if reply else "No fsmonitor running.")
+
+# run the daemon in this process
+def fsmonitor_run(repo):
+  path = repo_path(repo, "fsmonitor.sock")
+
+  # a socket nobody answers on was left by a daemon that died
+  if os.path.exists(path):
+    if fsmonitor_request(repo, { "command": "query" }):
+      raise Exception("fsmonitor already running")
+    os.unlink(path)
+
+  GitFsMonitor(repo).serve(path)
+
+# run the daemon in the background and wait for it to answer
+def fsmonitor_start(repo):
+  daemon_start("fsmonitor", lambda: fsmonitor_run(repo), lambda: fsmonitor_request(repo, { "command": "query" }))
+
+# run a daemon in a detached child and wait until ping answers
+def daemon_start(name, run, ping):
+  pid = os.fork()
+  if pid == 0:
+    # detach from the terminal and the session of the caller
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+      os.dup2(null, fd)
+    try:
+      run()
+    finally:
+      os._exit(0)
+
+  # watching a big worktree takes a while
+  for _ in range(600):
+    if ping():
+      print("{0} started, pid {1}.".format(name, pid))
+      return
+    time.sleep(0.05)
+  raise Exception("{0} did not start".format(name))
+
+# a wyag serve daemon runs the commands sent on .git/wyag.sock in its own process,
+# where the repositories stay open with their object cache, packs, refs, commit-graph and index
+# requests are json lines: {"command": "run", "argv": [...], "cwd": ..., "trace": ...}, "ping" or "quit"
+# the output of a command comes back in frames: a channel byte, 1 stdout, 2 stderr or x for the exit status,
+# the length of the data on 4 bytes and the data
+SERVE_FRAME = struct.Struct(">cI")
+
+# serve command
+@command("serve", help="Run a daemon answering wyag commands with warm caches.")
+def argsp_serve(argsp):
+  argsp.add_argument("action",
+                     choices=["run", "start", "stop", "status"],
+                     help="run in the foreground, start in the background, stop or check the daemon")
+
+def cmd_serve(args):
+  repo = repo_find()
+
+  match args.action:
+    case "run"    : serve_run(repo)
+    case "start"  : daemon_start("wyag serve", lambda: serve_run(repo), lambda: serve_request(repo, { "command": "ping" }))
+    case "stop"   :
+      if serve_request(repo, { "command": "quit" }) is None:
+        print("No wyag serve running.")
+    case "status" :
+      reply = serve_request(repo, { "command": "ping" })
+      print("wyag serve running, pid {0}, {1} commands served.".format(reply["pid"], reply["served"]) if reply else "No wyag serve running.")
+
+# send a ping or quit request to the daemon of the repo, None if there is no daemon answering
+def serve_request(repo, request):
+  import json
+  import socket
+
+  path = repo_path(repo, "wyag.sock")
+  if not os.path.exists(path):
+    return None
+
+  try:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+      conn.settimeout(FSMONITOR_TIMEOUT)
+      conn.connect(path)
+      conn.sendall(json.dumps(request).encode("utf8") + b'\n')
+      return json.loads(socket_read_line(conn))
+  except (OSError, ValueError):
+    return None
+
+# run the daemon in this process until told to quit
+def serve_run(repo):
+  import json
+  import socket
+
+  global repo_cache
+  path = repo_path(repo, "wyag.sock")
+
+  # a socket nobody answers on was left by a daemon that died
+  if os.path.exists(path):
+    if serve_request(repo, { "command": "ping" }):
+      raise Exception("wyag serve already running")
+    os.unlink(path)
+
+  repo_cache = { repo.worktree: (path_mtime(repo_path(repo, "config")), repo) }
+  served = 0
+
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(path)
+  server.listen(16)
+
+  try:
+    while True:
+      conn, _ = server.accept()
+      with conn:
+        try:
+          request = json.loads(socket_read_line(conn))
+          match request.get("command"):
+            case "run"  :
+              serve_command(conn, request)
+              served += 1
+            case "ping" : conn.sendall(json.dumps({ "pid": os.getpid(), "served": served }).encode("utf8") + b'\n')
+            case "quit" :
+              conn.sendall(json.dumps({ "ok": True }).encode("utf8") + b'\n')
+              return
+        except (OSError, ValueError):
+          pass # a client that went away or sent garbage
+  finally:
+    server.close()
+    os.unlink(path)
+    repo_cache = None
+
+# run one command with its output going back to the client
+def serve_command(conn, request):
+  import traceback
+
+  saved = (sys.stdout, sys.stderr, sys.stdin, os.getcwd(), os.environ.get("WYAG_TRACE"))
+  out = io.TextIOWrapper(io.BufferedWriter(GitServeStream(conn, b'1'), STREAM_CHUNK), encoding="utf8")
+  err = io.TextIOWrapper(io.BufferedWriter(GitServeStream(conn, b'2')), encoding="utf8", line_buffering=True)
+  # the client runs commands reading stdin itself
+  null = open(os.devnull, "r")
+  status = 0
+
+  try:
+    os.chdir(request["cwd"])
+    sys.stdout, sys.stderr, sys.stdin = out, err, null
+    if request.get("trace"):
+      os.environ["WYAG_TRACE"] = request["trace"]
+    else:
+      os.environ.pop("WYAG_TRACE", None)
+
+    # the set of existing objects is only trusted for one command, others may have pruned objects since
+    for _, repo in repo_cache.values():
+      repo.objects = None
+
+    try:
+      main(request["argv"])
+    except SystemExit as e:
+      if isinstance(e.code, int) or e.code is None:
+        status = e.code or 0
+      else:
+        print(e.code, file=sys.stderr)
+        status = 1
+    except Exception:
+      traceback.print_exc()
+      status = 1
+
+    out.flush()
+    err.flush()
+  finally:
+    null.close()
+    sys.stdout, sys.stderr, sys.stdin = saved[0:3]
+    os.chdir(saved[3])
+    if saved[4] is None:
+      os.environ.pop("WYAG_TRACE", None)
+    else:
+      os.environ["WYAG_TRACE"] = saved[4]
+
+  data = str(status).encode("ascii")
+  conn.sendall(SERVE_FRAME.pack(b'x', len(data)) + data)
+
+# raw stream sending what is written to it as frames of one channel of a served command
+class GitServeStream(io.RawIOBase):
+  """Output channel of a served command"""
+
+  def __init__(self, conn, channel):
+    self.conn = conn
+    self.channel = channel
+
+  def writable(self):
+    return True
 
+  def write(self, data):
+    self.conn.sendall(SERVE_FRAME.pack(self.channel, len(data)) + bytes(data))
+    return len(data)